@@ -0,0 +1,99 @@
+import asyncio
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+from db_engine.constants import DEFAULT_MAX_IN_FLIGHT, INGESTION_BACKLOG, INGESTION_READ_TIMEOUT, RECV_CHUNK_SIZE
+from db_engine.metrics import INGEST_REJECTED
+from db_engine.protocol import ProtocolError
+from utils.io import log, Color
+from utils.sockets import wait_bind_socket
+
+
+class AsyncIngestionServer:
+    """
+    Class responsible for accepting WRH measurements on asyncio event loop.
+    Wire protocol is the same as in threaded mode (see db_engine.protocol).
+    Number of chunks processed at the same time is bounded by max_in_flight: every connection may have one received
+    chunk waiting, but it is decoded and stored only once some slot is released, so further chunks are not read
+    (and TCP flow control slows the client down) until then.
+    """
+
+    def __init__(self, port, stream_factory, max_in_flight=DEFAULT_MAX_IN_FLIGHT, reuse_port=False):
+        """
+        :param port: listening port
+        :param stream_factory: callable accepting client address and returning IngestionStream
+        :param max_in_flight: maximal number of chunks processed concurrently
+        :param reuse_port: whether listening port may be shared with other processes (SO_REUSEPORT)
+        """
+        self.port = port
+        self.stream_factory = stream_factory
+        self.max_in_flight = max_in_flight
+        self.reuse_port = reuse_port
+        self.loop = None
+        self.server = None
+        self._in_flight = None
+        self._executor = None
+        self._should_end = False
+
+    def start(self):
+        """
+        Binds listening socket and runs event loop in the calling thread until stop() is called.
+        """
+        self._should_end = False
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if not wait_bind_socket(sock, '', self.port, sleep=10, retries=5, predicate=lambda: not self._should_end,
+                                error_message=f'Unable to bind to port {self.port}'):
+            sock.close()
+            self.loop.close()
+            return
+
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self._handle_connection, sock=sock, backlog=INGESTION_BACKLOG))
+        log(f'Listening for incoming connections on port {self.port} (asyncio, {self.max_in_flight} in flight)')
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self._executor.shutdown(wait=True)
+            self.loop.close()
+            self.server = None
+
+    def stop(self):
+        """
+        Stops accepting new connections. Safe to call from signal handlers and other threads.
+        """
+        self._should_end = True
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _handle_connection(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        stream = self.stream_factory(address)
+        try:
+            while not stream.finished:
+                chunk = await asyncio.wait_for(reader.read(RECV_CHUNK_SIZE), INGESTION_READ_TIMEOUT)
+                async with self._in_flight:
+                    reply = await self.loop.run_in_executor(self._executor, stream.feed, chunk)
+                if reply:
+                    writer.write(reply)
+                    await writer.drain()
+                if not chunk:
+                    break
+        except asyncio.TimeoutError:
+            INGEST_REJECTED.labels('timeout').inc()
+            log(f'Connection from {address} timed out', Color.WARNING)
+        except (ProtocolError, ConnectionError) as e:
+            INGEST_REJECTED.labels('protocol_error' if isinstance(e, ProtocolError) else 'connection_error').inc()
+            log(f'Dropping connection from {address}: {e}', Color.WARNING)
+        except Exception as e:
+            log(f'Error when handling connection from {address}: {e}', Color.FAIL)
+        finally:
+            writer.close()
@@ -0,0 +1,237 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+
+from db_engine.constants import NEGATIVE_TOKEN_CACHE_SIZE, CLIENT_INDEX_MISS_RELOAD_INTERVAL, RESPONSE_CACHE_SIZE, \
+    RESPONSE_CACHE_OPEN_WINDOW_TTL
+from db_engine.models import WRHClient, Module
+from db_engine.overlord_decorators import with_session
+from db_engine.statements import upsert
+
+
+class ClientTokenIndex:
+    """
+    In-memory token -> WRHClient index.
+    Whole wrh_client table is loaded once and reloaded after invalidate() or when ttl (in seconds) expires.
+    Unknown tokens may trigger at most one reload per miss_reload_interval and are then remembered in bounded
+    negative cache, so they cannot be used to flood the database with queries.
+    """
+
+    def __init__(self, sessionmaker, ttl=None, negative_cache_size=NEGATIVE_TOKEN_CACHE_SIZE,
+                 miss_reload_interval=CLIENT_INDEX_MISS_RELOAD_INTERVAL):
+        self.sessionmaker = sessionmaker
+        self.ttl = ttl
+        self.negative_cache_size = negative_cache_size
+        self.miss_reload_interval = miss_reload_interval
+        self._lock = threading.Lock()
+        self._clients = None
+        self._unknown_tokens = OrderedDict()
+        self._loaded_at = 0
+
+    @property
+    def clients(self):
+        with self._lock:
+            self._ensure_loaded()
+            return dict(self._clients)
+
+    def get(self, token):
+        with self._lock:
+            self._ensure_loaded()
+            client = self._clients.get(token)
+            if client or token in self._unknown_tokens:
+                return client
+            if time.monotonic() - self._loaded_at > self.miss_reload_interval:
+                self._load()
+                client = self._clients.get(token)
+            if not client:
+                self._unknown_tokens[token] = True
+                if len(self._unknown_tokens) > self.negative_cache_size:
+                    self._unknown_tokens.popitem(last=False)
+            return client
+
+    def invalidate(self):
+        with self._lock:
+            self._clients = None
+
+    def _ensure_loaded(self):
+        if self._clients is None or (self.ttl and time.monotonic() - self._loaded_at > self.ttl):
+            self._load()
+
+    def _load(self):
+        session = self.sessionmaker()
+        try:
+            self._clients = {c.token: c for c in session.query(WRHClient).all()}
+        finally:
+            session.close()
+        self._unknown_tokens.clear()
+        self._loaded_at = time.monotonic()
+
+
+class ModuleInfoCache:
+    """
+    Write-through cache of the module table keyed on (client_id, module_id).
+    Database is written only when type or name of the module differs from the cached one.
+    Instance is shared between ingestion path and Tornado server, so new modules are visible in UI immediately.
+    """
+
+    def __init__(self, sessionmaker, ttl=None):
+        self.sessionmaker = sessionmaker
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._modules = None
+        self._loaded_at = 0
+
+    @property
+    def modules(self):
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._modules.values())
+
+    def update(self, client_id, module_id, module_type, module_name):
+        """
+        Store module information unless it is already known.
+        :return: whether database has been written
+        :rtype: bool
+        """
+        if self.is_known(client_id, module_id, module_type, module_name):
+            return False
+        self._upsert(client_id, module_id, module_type, module_name)
+        self.remember(client_id, module_id, module_type, module_name)
+        return True
+
+    def is_known(self, client_id, module_id, module_type, module_name):
+        """
+        :return: whether module with exactly the same type and name is already stored
+        :rtype: bool
+        """
+        with self._lock:
+            self._ensure_loaded()
+            cached = self._modules.get((client_id, module_id))
+            return bool(cached and cached.type == module_type and cached.name == module_name)
+
+    @staticmethod
+    def write(session, client_id, module_id, module_type, module_name):
+        """
+        Upsert module information within given session, e.g. in the transaction storing its measurements.
+        Cache is not touched; remember() should be called once the transaction is committed.
+        """
+        upsert(session, Module, dict(id=module_id, client_id=client_id, type=module_type, name=module_name),
+               index_elements=('id', 'client_id'), update_columns=('type', 'name'))
+
+    def remember(self, client_id, module_id, module_type, module_name):
+        """
+        Store module information in memory only, e.g. when it has been written to database by another process.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            self._modules[(client_id, module_id)] = Module(id=module_id, client_id=client_id, type=module_type,
+                                                           name=module_name)
+
+    def invalidate(self):
+        with self._lock:
+            self._modules = None
+
+    @with_session
+    def _upsert(self, session, client_id, module_id, module_type, module_name):
+        self.write(session, client_id, module_id, module_type, module_name)
+
+    def _ensure_loaded(self):
+        if self._modules is None or (self.ttl and time.monotonic() - self._loaded_at > self.ttl):
+            session = self.sessionmaker()
+            try:
+                self._modules = {(m.client_id, m.id): m for m in session.query(Module).all()}
+            finally:
+                session.close()
+            self._loaded_at = time.monotonic()
+
+
+class ResponseCache:
+    """
+    LRU cache of module responses bounded by total length of cached responses.
+    Entries are keyed on (module WRHID, request window) and dropped as soon as a measurement falling into their window
+    is written. Windows ending in the past never expire on their own; windows reaching the present expire after
+    open_window_ttl seconds as a safety net for writes done by other processes.
+    Every invalidation bumps generation of the written module; response computed while its module has been written
+    is not stored (see generation and put), so it cannot outlive the measurement it misses.
+    """
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE, open_window_ttl=RESPONSE_CACHE_OPEN_WINDOW_TTL):
+        self.max_size = max_size
+        self.open_window_ttl = open_window_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (wrhid, request) -> (response, expiration time or None)
+        self._by_module = defaultdict(set)  # (wrhid, client_id, module_id) -> keys of entries
+        self._generations = defaultdict(int)  # (wrhid, client_id, module_id) -> number of invalidations
+        self._size = 0
+
+    def get(self, wrhid, request):
+        key = (wrhid, request)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] is not None and entry[1] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry:
+                self._entries.move_to_end(key)
+            return entry[0] if entry else None
+
+    def generation(self, wrhid, request):
+        """
+        :return: generation of requested module, which should be read before response is computed and passed to put
+        """
+        with self._lock:
+            return self._generations[(wrhid, request.client_id, request.module_id)]
+
+    def put(self, wrhid, request, response, generation=None):
+        """
+        Store response unless its module has been invalidated since given generation has been read.
+        """
+        if len(response) > self.max_size:
+            return
+        key = (wrhid, request)
+        module = (wrhid, request.client_id, request.module_id)
+        expires = time.monotonic() + self.open_window_ttl if request.until_date > datetime.now() else None
+        with self._lock:
+            if generation is not None and self._generations[module] != generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (response, expires)
+            self._by_module[module].add(key)
+            self._size += len(response)
+            while self._size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_packets(self, packets):
+        """
+        Drop entries whose windows contain any of written measurements.
+        :param packets: list of (client_id, packet) pairs
+        """
+        ranges, modules = {}, set()
+        for client_id, packet in packets:
+            module, date = (packet['module_type'], client_id, packet['module_id']), packet.get('date')
+            modules.add(module)
+            if isinstance(date, str):
+                first, last = ranges.get(module, (date, date))
+                ranges[module] = (min(first, date), max(last, date))  # Dates are fixed-width strings
+        with self._lock:
+            for module in modules:
+                self._generations[module] += 1
+            for module, (first, last) in ranges.items():
+                keys = self._by_module.get(module)
+                try:
+                    first, last = (datetime.strptime(d, '%Y-%m-%d %H:%M:%S') for d in (first, last))
+                except ValueError:
+                    first, last = datetime.min, datetime.max
+                for key in [k for k in keys or () if k[1].from_date <= last and first < k[1].until_date]:
+                    self._remove(key)
+
+    def _remove(self, key):
+        response, _ = self._entries.pop(key)
+        self._size -= len(response)
+        wrhid, request = key
+        module = (wrhid, request.client_id, request.module_id)
+        self._by_module[module].discard(key)
+        if not self._by_module[module]:
+            del self._by_module[module]
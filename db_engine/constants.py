@@ -6,3 +6,43 @@ ARGS_TORNADO_PORT = 'tornado_port'
 ARGS_PATH = 'path'
 ARGS_INTERACTIVE = 'interactive'
 ADDITIONAL_DB_MODULES_PATH = 'modules/'
+ARGS_ASYNCIO = 'asyncio'
+ARGS_MAX_IN_FLIGHT = 'max_in_flight'
+DEFAULT_MAX_IN_FLIGHT = 64
+INGESTION_BACKLOG = 128
+INGESTION_READ_TIMEOUT = 10
+RECV_CHUNK_SIZE = 4096
+MAX_FRAME_SIZE = 1024 * 1024
+STREAM_MAGIC_NDJSON = b'WRHN'
+STREAM_MAGIC_LENGTH_PREFIXED = b'WRHL'
+WRITER_BATCH_SIZE = 1000
+WRITER_FLUSH_INTERVAL = 1.0
+WRITER_QUEUE_SIZE = 100000
+WRITER_QUEUE_PUT_TIMEOUT = 5
+CLIENT_INDEX_TTL = 300
+MODULE_CACHE_TTL = 600
+CLIENT_INDEX_MISS_RELOAD_INTERVAL = 30
+NEGATIVE_TOKEN_CACHE_SIZE = 1024
+COMPRESSION_MIN_LENGTH = 1024
+RESPONSE_CACHE_SIZE = 64 * 1024 * 1024
+RESPONSE_CACHE_OPEN_WINDOW_TTL = 300
+ASYNC_DB_EXECUTOR_SIZE = 10
+LIVE_QUEUE_SIZE = 1000
+ARGS_WORKERS = 'workers'
+EVENTS_QUEUE_SIZE = 10000
+WORKERS_SHUTDOWN_TIMEOUT = 30
+METRICS_SNAPSHOT_INTERVAL = 5
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PACKET_LOG_LIMIT = 10
+PACKET_LOG_INTERVAL = 10
+ARGS_SPOOL = 'spool'
+SPOOL_DIR = '.wrh.spool'
+SPOOL_SEGMENT_SIZE = 16 * 1024 * 1024
+SPOOL_READ_CHUNK = 1024 * 1024
+SPOOL_RETRY_INTERVAL = 5
+RETENTION_CONFIG_FILE = '.wrh.retention.config'
+RETENTION_INTERVAL = 3600
+RETENTION_BATCH_SIZE = 5000
+RETENTION_BATCH_PAUSE = 0.1
+MODULES_MANIFEST_FILE = '.wrh.modules.manifest'
+SCHEMA_FILES = ('db_engine/models.py', 'db_engine/rollups.py', 'db_engine/schema.py', 'modules/base.py')
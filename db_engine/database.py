@@ -0,0 +1,125 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from db_engine.constants import ASYNC_DB_EXECUTOR_SIZE
+from utils.io import log, Color
+
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+except ImportError:
+    create_async_engine = AsyncSession = None
+
+DEFAULT_ASYNC_DIALECTS = {'postgresql': 'postgresql+asyncpg'}
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle', 'pool_pre_ping')
+
+
+def database_url(db_configuration, dialect=None):
+    """
+    Build database URL out of .wrh.db.config contents.
+    Complete URL may be given with "url" key instead of separate connection parameters (e.g. for SQLite).
+    :param db_configuration: parsed configuration file
+    :param dialect: dialect overriding the configured one
+    :rtype: str
+    """
+    if 'url' in db_configuration:
+        url = db_configuration['url']
+        return f'{dialect}{url[url.index("://"):]}' if dialect else url
+    return '{dialect}://{username}:{password}@{host}:{port}/{database}'.format(
+        **dict(db_configuration, dialect=dialect or db_configuration['dialect']))
+
+
+def database_dialect(db_configuration):
+    """
+    Return name of configured database backend (without driver part).
+    """
+    dialect = db_configuration['url'].split('://')[0] if 'url' in db_configuration else db_configuration['dialect']
+    return dialect.split('+')[0]
+
+
+def engine_options(db_configuration, dialect=None):
+    """
+    Build create_engine keyword arguments out of optional pool settings of .wrh.db.config
+    ("pool_size", "max_overflow", "pool_timeout", "pool_recycle", "pool_pre_ping") and "statement_timeout"
+    (in milliseconds, PostgreSQL only).
+    :param db_configuration: parsed configuration file
+    :param dialect: dialect overriding the configured one
+    :rtype: dict
+    """
+    options = {k: db_configuration[k] for k in POOL_OPTIONS if k in db_configuration}
+    timeout = db_configuration.get('statement_timeout')
+    if timeout is not None:
+        dialect = dialect or db_configuration.get('dialect') or db_configuration['url'].split('://')[0]
+        if dialect.split('+')[0] != 'postgresql':
+            log(f'statement_timeout is not supported for {dialect}, ignoring it', Color.WARNING)
+        elif dialect.endswith('+asyncpg'):
+            options['connect_args'] = {'server_settings': {'statement_timeout': str(timeout)}}
+        else:
+            options['connect_args'] = {'options': f'-c statement_timeout={timeout}'}
+    return options
+
+
+class AsyncSessionFactory:
+    """
+    Factory of asynchronous per-request sessions used by Tornado handlers.
+    Native SQLAlchemy asyncio engine is used whenever it is available for configured database
+    ("async_dialect" in .wrh.db.config, postgresql+asyncpg for PostgreSQL by default), so queries never leave
+    the event loop. Otherwise sessions run synchronous queries in dedicated, bounded thread pool.
+    Either way sessions expose awaitable execute(statement, params), commit() and close().
+    """
+
+    def __init__(self, db_configuration, sessionmaker):
+        self.sessionmaker = sessionmaker
+        self.engine = self._create_async_engine(db_configuration)
+        self._executor = None if self.engine else ThreadPoolExecutor(max_workers=ASYNC_DB_EXECUTOR_SIZE)
+
+    def __call__(self):
+        if self.engine:
+            return AsyncSession(self.engine, expire_on_commit=False)
+        return ExecutorSession(self.sessionmaker(), self._executor)
+
+    @staticmethod
+    def _create_async_engine(db_configuration):
+        dialect = db_configuration.get('async_dialect', DEFAULT_ASYNC_DIALECTS.get(database_dialect(db_configuration)))
+        if not create_async_engine or not dialect:
+            return None
+        try:
+            return create_async_engine(database_url(db_configuration, dialect),
+                                       **engine_options(db_configuration, dialect))
+        except ImportError as e:
+            log(f'Asynchronous database driver is not available ({e}), falling back to thread pool', Color.WARNING)
+            return None
+
+
+class ExecutorSession:
+    """
+    Asynchronous facade of synchronous session running every statement in thread pool.
+    Results are fetched inside the pool, so nothing blocks the event loop.
+    """
+
+    def __init__(self, session, executor):
+        self._session = session
+        self._executor = executor
+
+    async def execute(self, statement, params=None):
+        return await self._run(self._execute, statement, params)
+
+    async def commit(self):
+        await self._run(self._session.commit)
+
+    async def close(self):
+        await self._run(self._session.close)
+
+    def _execute(self, statement, params):
+        result = self._session.execute(statement, params)
+        return BufferedResult(result.fetchall() if result.returns_rows else [])
+
+    def _run(self, function, *args):
+        return asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+
+
+class BufferedResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        return self.rows
@@ -1,18 +1,36 @@
 import hashlib
 import json
+import queue
 import signal
 import socket
+import threading
+from collections import defaultdict
 from datetime import datetime
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
 
-from db_engine import Base, WRH_MODULES
-from db_engine.constants import DB_CONFIG_FILE
-from db_engine.models import WRHClient, Measurement, Module
+from db_engine import WRH_MODULES
+from db_engine.async_ingestion import AsyncIngestionServer
+from db_engine.caches import ClientTokenIndex, ModuleInfoCache, ResponseCache
+from db_engine.constants import DB_CONFIG_FILE, DEFAULT_MAX_IN_FLIGHT, CLIENT_INDEX_TTL, MODULE_CACHE_TTL, \
+    RECV_CHUNK_SIZE, INGESTION_READ_TIMEOUT, PACKET_LOG_LIMIT, PACKET_LOG_INTERVAL, SPOOL_DIR
+from db_engine.database import database_url, engine_options, AsyncSessionFactory
+from db_engine.metrics import REGISTRY, MetricsSnapshot, RateLimitedLog, INGEST_CONNECTIONS, \
+    INGEST_TOKEN_LOOKUP_SECONDS, INGEST_MODULE_INFO_SECONDS, INGEST_ACCEPTED, INGEST_REJECTED, WRITER_QUEUE_DEPTH
+from db_engine.models import WRHClient, Measurement
 from db_engine.overlord_decorators import with_session
+from db_engine.protocol import IngestionStream, ProtocolError
+from db_engine.pubsub import MeasurementBroker
+from db_engine.rollups import RAW, DAILY, has_rollups, get_rollup_table, rebuild_rollups
+from db_engine.retention import RetentionPolicy, RetentionJob
+from db_engine.schema import ensure_schema
+from db_engine.spool import Spool
 from db_engine.tornado.server import TornadoServer
-from utils.decorators import with_open, in_thread, log_exceptions
+from db_engine.writer import MeasurementWriter
+from modules.base import ModuleBase
+from utils.decorators import with_open, in_thread
 from utils.io import log, Color, wrh_input, non_empty_positive_numeric_input
 from utils.sockets import wait_bind_socket, await_connection
 
@@ -20,35 +38,111 @@ npinput = non_empty_positive_numeric_input
 
 
 class DBEngine:
-    def __init__(self, port, tornado_port):
+    def __init__(self, port, tornado_port, use_asyncio=False, max_in_flight=DEFAULT_MAX_IN_FLIGHT, reuse_port=False,
+                 create_schema=True, db_configuration=None, spool_dir=None):
         self.socket = None
         self.port = port
+        self.reuse_port = reuse_port
+        self.create_schema = create_schema
+        self.async_server = AsyncIngestionServer(port, self._new_stream, max_in_flight, reuse_port) \
+            if use_asyncio else None
         self._should_end = False
-        log('Following additional db models have been found: \n*{}'.format(
-            '\n*'.join(str(m.__name__) for m in WRH_MODULES)), Color.BLUE)
-        self.wrh_modules = {m.WRHID: m for m in WRH_MODULES}
-        self._read_db_configuration()
-        self.tornado_server = TornadoServer(tornado_port, self.sessionmaker)
+        self.wrh_modules = WRH_MODULES
+        log(f'Available WRH modules: {", ".join(self.wrh_modules.wrhids)}', Color.BLUE)
+        self.schema_updated = False
+        self._connect(db_configuration or self._read_db_configuration())
+        self.client_index = ClientTokenIndex(self.sessionmaker, ttl=CLIENT_INDEX_TTL)
+        self.module_cache = ModuleInfoCache(self.sessionmaker, ttl=MODULE_CACHE_TTL)
+        self.response_cache = ResponseCache()
+        self.writer = MeasurementWriter(self.sessionmaker, self._rows_from_packets,
+                                        prepare=self._write_module_info if self.unit_of_work else None,
+                                        spool=Spool(spool_dir) if spool_dir else None)
+        self._packet_log = RateLimitedLog(PACKET_LOG_LIMIT, PACKET_LOG_INTERVAL)
+        WRITER_QUEUE_DEPTH.set_function(lambda: self.writer.queue_depth)
+        self.broker = MeasurementBroker()
+        self.retention_policy = RetentionPolicy.load()
+        WRH_MODULES.add_load_hook(self.retention_policy.apply_to)
+        self.retention_job = RetentionJob(self.sessionmaker, self.retention_policy, WRH_MODULES)
+        if self.unit_of_work:
+            self.writer.add_listener(self._remember_module_info)
+        self.writer.add_listener(self.response_cache.invalidate_packets)
+        self.writer.add_listener(self.broker.publish_packets)
+        self.tornado_server = TornadoServer(tornado_port, self.async_sessionmaker, self.module_cache,
+                                            self.response_cache, self.broker)
 
     @property
     def wrh_clients(self):
-        session = self.sessionmaker()
-        try:
-            clients = session.query(WRHClient).all()
-        finally:
-            session.close()
-        return {c.token: c for c in clients}
+        return self.client_index.clients
 
-    def start_work(self):
+    def start_work(self, serve_ui=True, backfill=True, retention=True):
+        """
+        Accept measurements until SIGINT or SIGTERM is received.
+        :param serve_ui: whether Tornado server should be run in this process as well
+        :param backfill: whether empty rollup tables should be built before starting (when schema has been updated)
+        :param retention: whether retention policy should be enforced by this process
+        """
         if not self.wrh_clients:
             log('No point in running while there are no clients configured!', Color.WARNING)
         else:
             self._should_end = False
             signal.signal(signal.SIGINT, self._sigint_handler)
-            self._start_tornado()
-            self._await_connections()
+            signal.signal(signal.SIGTERM, self._sigint_handler)
+            if backfill and self.schema_updated:
+                self.backfill_rollups()
+            self.writer.start()
+            if retention:
+                self.retention_job.start()
+            if serve_ui:
+                self._start_tornado()
+            if self.async_server:
+                self.async_server.start()
+            else:
+                self._await_connections()
             log('Stopping work')
+            self.retention_job.stop()
+            self.writer.stop()
             signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    def serve_ui(self, events=None):
+        """
+        Run only Tornado server in the calling thread until SIGINT or SIGTERM is received.
+        :param events: optional queue of (client_id, packet) lists stored by other processes, which are applied
+        to local caches and live subscriptions, and of MetricsSnapshot of those processes merged into local metrics
+        """
+        if events is not None:
+            threading.Thread(target=self._consume_events, args=(events,), name='EventsConsumer', daemon=True).start()
+        signal.signal(signal.SIGINT, lambda *_: self.tornado_server.stop_from_signal())
+        signal.signal(signal.SIGTERM, lambda *_: self.tornado_server.stop_from_signal())
+        self.tornado_server.start()
+
+    def drain_spools(self, used=()):
+        """
+        Store measurements left in spools which no writer of this run uses (see Spool.find_orphaned), so that
+        already acknowledged measurements are never stranded on disk. Drained spools are removed; spools which
+        cannot be drained because database is unavailable are kept for the next start.
+        Must be called before writers of this run are started.
+        :param used: spool directories of writers of this run
+        """
+        for directory in Spool.find_orphaned(SPOOL_DIR, used):
+            spool = Spool(directory)
+            writer = MeasurementWriter(self.sessionmaker, self._rows_from_packets, spool=spool,
+                                       prepare=self._write_module_info if self.unit_of_work else None)
+            writer.flush()
+            spool.close()
+            if spool.depth:
+                log(f'{spool.depth} measurements left in {directory} could not be stored yet', Color.WARNING)
+            else:
+                spool.remove()
+
+    @with_session
+    def backfill_rollups(self, session):
+        if session.bind.dialect.name != 'postgresql':
+            return
+        for table in (m.__table__ for m in WRH_MODULES if has_rollups(m.__table__)):
+            if not session.execute(get_rollup_table(table, DAILY).select().limit(1)).first():
+                log(f'Building rollups of {table.name} from existing measurements')
+                rebuild_rollups(session, table)
 
     def run_interactive(self):
         log('*** Existing clients ***')
@@ -56,25 +150,32 @@ class DBEngine:
         choices = {1: ('Add new WRH client', self._add_new_client),
                    2: ('Edit existing WRH client', self._modify_client),
                    3: ('Delete existing WRH client', self._delete_client),
-                   4: ('Start work', self.start_work), 5: ('Exit', lambda: None)}
+                   4: ('Configure retention policy', self._configure_retention),
+                   5: ('Start work', self.start_work), 6: ('Exit', lambda: None)}
         choice = -1
-        while choice != 5:
+        while choice != 6:
             [log(f'{k}) {v[0]}') for k, v in choices.items()]
             choice = wrh_input(message='> ', input_type=int, sanitizer=lambda x: 1 <= x <= len(choices),
                                allowed_exceptions=(ValueError,))
             choices[choice][1]()  # run selected procedure
-            if choice in (1, 2, 3):
+            if choice in (1, 2, 3, 4):
                 log('Sucess!\n\n', Color.GREEN)
 
     @with_open(DB_CONFIG_FILE, 'r', ())
     def _read_db_configuration(self, _file_=None):
+        return json.loads(_file_.read())
+
+    def _connect(self, db_configuration):
         try:
             log('Connecting to database')
-            db_configuration = json.loads(_file_.read())
-            self.db_engine = create_engine('{dialect}://{username}:{password}@{host}:{port}/{database}'.format(
-                **db_configuration))
-            Base.metadata.create_all(self.db_engine)
+            if not db_configuration:
+                raise IOError(f'Database configuration file {DB_CONFIG_FILE} is missing or empty')
+            self.db_engine = create_engine(database_url(db_configuration), **engine_options(db_configuration))
+            self.unit_of_work = db_configuration.get('unit_of_work', False)
+            if self.create_schema:
+                self.schema_updated = ensure_schema(self.db_engine, brin=db_configuration.get('brin_indexes', False))
             self.sessionmaker = sessionmaker(bind=self.db_engine)
+            self.async_sessionmaker = AsyncSessionFactory(db_configuration, self.sessionmaker)
         except (IOError, KeyError) as e:
             log(f'Error when trying to read db configuration: {e}', Color.FAIL)
             raise
@@ -83,6 +184,8 @@ class DBEngine:
         predicate = lambda: self._should_end is False
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         bind_result = wait_bind_socket(self.socket, '', self.port, sleep=10, retries=5, predicate=predicate,
                                        error_message=f'Unable to bind to port {self.port}')
         if bind_result:
@@ -96,35 +199,113 @@ class DBEngine:
 
     @in_thread
     def _new_connection(self, connection, address):
+        stream = self._new_stream(address)
         try:
-            data = json.loads(connection.recv(4096).decode('utf-8').replace('\0', ''))
-            log(f'New connection from {address} who sent: {data}')
-            wrh_client = self.wrh_clients.get(data['token'])
-            if wrh_client:
-                self._update_module_info(wrh_client.id, data['module_id'], data['module_type'], data['module_name'])
-                self._upload_new_measurement(wrh_client, data)
+            connection.settimeout(INGESTION_READ_TIMEOUT)
+            while not stream.finished:
+                chunk = connection.recv(RECV_CHUNK_SIZE)
+                reply = stream.feed(chunk)
+                if reply:
+                    connection.sendall(reply)
+                if not chunk:
+                    break
+        except (ProtocolError, OSError) as e:
+            INGEST_REJECTED.labels('protocol_error' if isinstance(e, ProtocolError) else 'connection_error').inc()
+            log(f'Dropping connection from {address}: {e}', Color.WARNING)
         finally:
             connection.close()
 
-    @log_exceptions()
-    @with_session
-    def _upload_new_measurement(self, session, wrh_client, data):
-        measurement = Measurement(client_id=wrh_client.id,
-                                  module_id=data['module_id'],
-                                  timestamp=datetime.strptime(data['date'], '%Y-%m-%d %H:%M:%S'),
-                                  # e.g. 2017-01-01 12:00:00
-                                  data=data['measurement'])
-        dedicated_model = self.wrh_modules.get(data['module_type'])
-        session.add(dedicated_model.get_object(measurement) if dedicated_model else measurement)
+    def _new_stream(self, address):
+        INGEST_CONNECTIONS.inc()
+        return IngestionStream(lambda data: self._process_record(data, address))
 
-    @with_session
-    def _update_module_info(self, session, client_id, module_id, module_type, module_name):
-        module = session.query(Module).filter(Module.id == module_id, Module.client_id == client_id).first()
-        if not module:
-            module = Module(id=module_id, client_id=client_id, type=module_type, name=module_name)
-            session.add(module)
-        elif module.name != module_name:
-            module.name = module_name
+    def _process_record(self, data, address):
+        self._packet_log('New connection from {} who sent: {}', address, data)
+        try:
+            with INGEST_TOKEN_LOOKUP_SECONDS.time():
+                wrh_client = self.client_index.get(data['token'])
+            if wrh_client:
+                module_info = (wrh_client.id, data['module_id'], data['module_type'], data['module_name'])
+                if not self.unit_of_work:
+                    with INGEST_MODULE_INFO_SECONDS.time():
+                        self._update_module_info(*module_info)
+                self._upload_new_measurement(wrh_client, data)
+        except (KeyError, TypeError, ValueError) as e:
+            INGEST_REJECTED.labels('malformed').inc()
+            self._packet_log('Malformed measurement from {}: {}', address, e, color=Color.WARNING)
+            return False
+        except SQLAlchemyError as e:
+            # Sessions of the caches are closed (rolled back) by with_session; next record gets a fresh one
+            INGEST_REJECTED.labels('database_error').inc()
+            self._packet_log('Unable to process measurement from {}: {}', address, e, color=Color.FAIL)
+            return False
+        except queue.Full:
+            INGEST_REJECTED.labels('queue_full').inc()
+            self._packet_log('Rejecting measurement from {}, writer queue is full', address, color=Color.WARNING)
+            return False
+        if wrh_client:
+            INGEST_ACCEPTED.inc()
+        else:
+            INGEST_REJECTED.labels('unknown_token').inc()
+        return wrh_client is not None
+
+    def _upload_new_measurement(self, wrh_client, data):
+        self.writer.put(wrh_client.id, data)
+
+    def _rows_from_packets(self, packets):
+        rows, batches = defaultdict(list), defaultdict(list)
+        for client_id, data in packets:
+            batches[data['module_type'] if data['module_type'] in self.wrh_modules else None].append((client_id, data))
+        for wrhid, batch in batches.items():
+            model = self.wrh_modules.get(wrhid)
+            converted = model.get_rows(batch) if model else self._generic_rows(batch)
+            if converted is None:
+                converted = self._rows_from_objects(batch, model)
+            table_rows, rejected = converted
+            rows[model.__table__ if model else Measurement.__table__].extend(table_rows)
+            for data, reason in rejected:
+                INGEST_REJECTED.labels('invalid_measurement').inc()
+                self._packet_log('Skipping invalid measurement {}: {}', data, reason, color=Color.WARNING)
+        return rows
+
+    @staticmethod
+    def _generic_rows(batch):
+        rows, rejected = [], []
+        for (client_id, data), timestamp in zip(batch, ModuleBase.parse_timestamps([d.get('date') for _, d in batch])):
+            if timestamp is None or data.get('measurement') is None:
+                rejected.append((data, 'invalid date or measurement'))
+            else:
+                rows.append({'client_id': client_id, 'module_id': data['module_id'], 'timestamp': timestamp,
+                             'data': data['measurement']})
+        return rows, rejected
+
+    def _rows_from_objects(self, batch, dedicated_model):
+        # Fallback for modules without get_rows: ORM object is built for every measurement
+        rows, rejected = [], []
+        for client_id, data in batch:
+            try:
+                measurement = Measurement(client_id=client_id,
+                                          module_id=data['module_id'],
+                                          timestamp=datetime.strptime(data['date'], '%Y-%m-%d %H:%M:%S'),
+                                          # e.g. 2017-01-01 12:00:00
+                                          data=data['measurement'])
+                rows.append(self._as_row(dedicated_model.get_object(measurement)))
+            except (KeyError, TypeError, ValueError) as e:
+                rejected.append((data, e))
+        return rows, rejected
+
+    def _update_module_info(self, client_id, module_id, module_type, module_name):
+        self.module_cache.update(client_id, module_id, module_type, module_name)
+
+    def _write_module_info(self, session, packets):
+        # Unit-of-work mode: module information is stored in the same transaction as the measurements
+        for client_id, module_id, module_type, module_name in self._modules_of(packets):
+            if not self.module_cache.is_known(client_id, module_id, module_type, module_name):
+                self.module_cache.write(session, client_id, module_id, module_type, module_name)
+
+    def _remember_module_info(self, packets):
+        for module_info in self._modules_of(packets):
+            self.module_cache.remember(*module_info)
 
     @with_session
     def _add_new_client(self, session):
@@ -132,6 +313,7 @@ class DBEngine:
         client_name = wrh_input(message='Input name of new client: ')
         client = WRHClient(name=client_name, token=self._generate_client_token(client_name))
         session.add(client)
+        self._invalidate_clients_on_commit(session)
 
     @with_session
     def _modify_client(self, session):
@@ -141,6 +323,7 @@ class DBEngine:
         to_edit = session.query(WRHClient).filter(WRHClient.id == client_id).first()
         if to_edit:
             to_edit.name = wrh_input(message='Input new name of the client: ')
+            self._invalidate_clients_on_commit(session)
 
     @with_session
     def _delete_client(self, session):
@@ -150,13 +333,59 @@ class DBEngine:
         to_remove = session.query(WRHClient).filter(WRHClient.id == client_id).first()
         if to_remove:
             session.delete(to_remove)
+            self._invalidate_clients_on_commit(session)
+
+    def _invalidate_clients_on_commit(self, session):
+        # Invalidating earlier would let concurrent token lookup reload and cache clients from before the commit
+        event.listen(session, 'after_commit', lambda _: self.client_index.invalidate())
+
+    def _configure_retention(self):
+        log('\n*** Retention policy (days for which rows are kept, 0 means forever) ***')
+        policy = self.retention_policy
+        for table in [Measurement.__table__] + [m.__table__ for m in WRH_MODULES]:
+            for resolution in policy.RESOLUTIONS if has_rollups(table) else (RAW,):
+                current = policy.days(table.name, resolution) or 0
+                days = wrh_input(message=f'{table.name}, {resolution} rows (now {current}): ', input_type=int,
+                                 sanitizer=lambda x: x >= 0, allowed_exceptions=(ValueError,))
+                policy.set_days(table.name, resolution, days)
+        policy.drop_generic_copies = wrh_input(
+            message='Remove generic copies of measurements stored by dedicated modules? (y/n): ',
+            sanitizer=lambda x: x.lower() in ('y', 'n')).lower() == 'y'
+        policy.save()
+        [policy.apply_to(m) for m in WRH_MODULES]
+
+    def _consume_events(self, events):
+        for packets in iter(events.get, None):
+            if isinstance(packets, MetricsSnapshot):
+                REGISTRY.merge(packets.source, packets.metrics)
+                continue
+            for client_id, packet in packets:
+                self.module_cache.remember(client_id, packet['module_id'], packet['module_type'], packet['module_name'])
+            self.response_cache.invalidate_packets(packets)
+            self.broker.publish_packets(packets)
 
     def _sigint_handler(self, *_):
+        if self._should_end:
+            return
         self.tornado_server.stop()
         self._should_end = True
+        if self.async_server:
+            self.async_server.stop()
         if self.socket:
             self.socket.shutdown(socket.SHUT_RDWR)
             self.socket.close()
+        log(f'Flushing {self.writer.queue_depth} queued measurements')
+        self.writer.stop()
+
+    @staticmethod
+    def _modules_of(packets):
+        modules = {(client_id, p['module_id']): (p['module_type'], p['module_name']) for client_id, p in packets}
+        return [(client_id, module_id, *info) for (client_id, module_id), info in modules.items()]
+
+    @staticmethod
+    def _as_row(obj):
+        values = ((c, getattr(obj, c.key)) for c in obj.__table__.columns)
+        return {c.key: value for c, value in values if not (c.primary_key and value is None)}
 
     @staticmethod
     def _generate_client_token(client_name):
@@ -0,0 +1,281 @@
+import bisect
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from db_engine.constants import LATENCY_BUCKETS
+from utils.io import log
+
+MetricsSnapshot = namedtuple('MetricsSnapshot', 'source metrics')  # Sent by prefork workers, see Registry.merge
+
+
+class Metric:
+    """
+    Base of metrics exported in Prometheus text format.
+    Metric with label names is a family of children created on demand with labels(); metric without labels
+    is its own single child.
+    State of every child is a plain picklable value, so snapshots of metrics may be sent between processes
+    and merged when rendering.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        if not self.labelnames:
+            self.labels()
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'Metric {self.name} expects labels {self.labelnames}, got {values}')
+        values = tuple(str(v) for v in values)
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._new_child()
+            return child
+
+    def snapshot(self):
+        """
+        :return: label values -> state of every child
+        :rtype: dict
+        """
+        with self._lock:
+            children = list(self._children.items())
+        return {values: child.state() for values, child in children}
+
+    def render(self, snapshots=()):
+        """
+        :param snapshots: snapshots of the same metric taken in other processes, which are added to local values
+        """
+        states = self.snapshot()
+        for snapshot in snapshots:
+            for values, state in snapshot.items():
+                states[values] = self._merge(states[values], state) if values in states else state
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for values, state in sorted(states.items()):
+            labels = dict(zip(self.labelnames, values))
+            lines.extend(f'{self.name}{suffix}{self._format_labels(dict(labels, **extra))} {value}'
+                         for suffix, extra, value in self._samples(state))
+        return '\n'.join(lines)
+
+    def _default_child(self):
+        return self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self, state):
+        raise NotImplementedError
+
+    @staticmethod
+    def _merge(state, other):
+        return state + other
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', r'\\').replace('"', r'\"'))
+                              for k, v in labels.items()) + '}'
+
+
+class _CounterChild:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def state(self):
+        return self.value
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.function = lambda: 0
+
+    def set_function(self, function):
+        self.function = function
+
+    def state(self):
+        return self.function()
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def state(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1):
+        self._default_child().inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _samples(self, state):
+        return [('_total', {}, state)]
+
+
+class Gauge(Metric):
+    """
+    Gauge whose value is read from callback at scrape time; values of other processes are summed.
+    """
+    type = 'gauge'
+
+    def set_function(self, function):
+        self._default_child().set_function(function)
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def _samples(self, state):
+        return [('', {}, state)]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value):
+        self._default_child().observe(value)
+
+    def time(self):
+        return self._default_child().time()
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _samples(self, state):
+        counts, total = state
+        cumulative, samples = 0, []
+        for bound, count in zip([*self.buckets, '+Inf'], counts):
+            cumulative += count
+            samples.append(('_bucket', {'le': str(bound)}, cumulative))
+        return samples + [('_sum', {}, total), ('_count', {}, cumulative)]
+
+    @staticmethod
+    def _merge(state, other):
+        return [a + b for a, b in zip(state[0], other[0])], state[1] + other[1]
+
+
+class Registry:
+    """
+    Metrics of this process. Latest snapshots of other processes (prefork ingestion workers) may be merged in,
+    so that single scrape covers all of them.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+        self._remote = {}  # source -> {metric name: snapshot}
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        """
+        :return: picklable snapshot of all registered metrics, to be merged in another process
+        :rtype: dict
+        """
+        return {m.name: m.snapshot() for m in self._metrics}
+
+    def merge(self, source, snapshot):
+        """
+        Remember the latest snapshot taken in another process; it replaces previous snapshot of the same source.
+        """
+        with self._lock:
+            self._remote[source] = snapshot
+
+    def render(self):
+        """
+        :return: all registered metrics (summed with merged snapshots) in Prometheus text exposition format
+        :rtype: str
+        """
+        with self._lock:
+            remote = list(self._remote.values())
+        return '\n'.join(m.render([r[m.name] for r in remote if m.name in r]) for m in self._metrics) + '\n'
+
+
+class RateLimitedLog:
+    """
+    Logs at most limit messages per interval seconds; messages above the limit are only counted
+    and their number is reported once the interval passes. Message is formatted only when it is actually logged.
+    """
+
+    def __init__(self, limit, interval):
+        self.limit = limit
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._window_start = 0
+        self._logged = self._suppressed = 0
+
+    def __call__(self, message, *args, color=None):
+        with self._lock:
+            now = time.monotonic()
+            suppressed = 0
+            if now - self._window_start >= self.interval:
+                suppressed, self._suppressed = self._suppressed, 0
+                self._window_start, self._logged = now, 0
+            emit = self._logged < self.limit
+            if emit:
+                self._logged += 1
+            else:
+                self._suppressed += 1
+        if suppressed:
+            log(f'{suppressed} similar messages were suppressed')
+        if emit:
+            message = message.format(*args)
+            log(message, color) if color else log(message)
+
+
+REGISTRY = Registry()
+INGEST_CONNECTIONS = REGISTRY.register(Counter('wrh_ingest_connections', 'Accepted ingestion connections.'))
+INGEST_DECODE_SECONDS = REGISTRY.register(Histogram('wrh_ingest_decode_seconds', 'Decoding of received chunks.'))
+INGEST_TOKEN_LOOKUP_SECONDS = REGISTRY.register(Histogram('wrh_ingest_token_lookup_seconds',
+                                                          'Lookups of client tokens.'))
+INGEST_MODULE_INFO_SECONDS = REGISTRY.register(Histogram('wrh_ingest_module_info_seconds',
+                                                         'Updates of module information.'))
+INGEST_ACCEPTED = REGISTRY.register(Counter('wrh_ingest_accepted_packets', 'Packets accepted for writing.'))
+INGEST_REJECTED = REGISTRY.register(Counter('wrh_ingest_rejected_packets', 'Packets rejected or dropped.',
+                                            ('reason',)))
+WRITER_QUEUE_DEPTH = REGISTRY.register(Gauge('wrh_writer_queue_depth', 'Packets waiting for the writer.'))
+WRITER_COMMIT_SECONDS = REGISTRY.register(Histogram('wrh_writer_commit_seconds', 'Batch insert transactions.'))
+WRITER_COMMIT_LATENCY_SECONDS = REGISTRY.register(Histogram('wrh_writer_commit_latency_seconds',
+                                                            'Time from accepting packet to its commit.'))
+WRITER_WRITTEN = REGISTRY.register(Counter('wrh_writer_written_packets', 'Committed packets.'))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram('wrh_http_request_seconds', 'Module requests served by Tornado.',
+                                                   ('module_class', 'cached')))
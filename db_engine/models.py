@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, text, TIMESTAMP, ForeignKey
+from sqlalchemy import Column, Integer, String, text, TIMESTAMP, ForeignKey, Index, JSON
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 
@@ -27,4 +27,6 @@ class Measurement(Base):
     client_id = Column(Integer, ForeignKey('wrh_client.id'), nullable=False, index=True)
     module_id = Column(Integer, nullable=False, index=True)
     timestamp = Column(TIMESTAMP, nullable=False)
-    data = Column(JSONB, nullable=False, server_default=text("'{}'"))
+    data = Column(JSONB().with_variant(JSON(), 'sqlite'), nullable=False, server_default=text("'{}'"))
+    __table_args__ = (Index('ux_measurement_client_module_timestamp', 'client_id', 'module_id', 'timestamp',
+                            unique=True),)
@@ -15,3 +15,22 @@ def with_session(method):
         return results
 
     return inner
+
+
+def with_async_session(method):
+    """
+    Decorator for running coroutine method with active asynchronous session which will be committed and closed
+    only after awaited method finishes.
+    Decorated class must have async_sessionmaker field.
+    """
+
+    async def inner(self, *args, **kwargs):
+        session = self.async_sessionmaker()
+        try:
+            results = await method(self, session, *args, **kwargs)
+            await session.commit()
+        finally:
+            await session.close()
+        return results
+
+    return inner
@@ -0,0 +1,175 @@
+import json
+import struct
+import time
+
+from db_engine.constants import STREAM_MAGIC_NDJSON, STREAM_MAGIC_LENGTH_PREFIXED, MAX_FRAME_SIZE
+from db_engine.metrics import INGEST_DECODE_SECONDS, INGEST_REJECTED
+from utils.io import log, Color
+
+BATCH_END = object()
+INVALID = object()
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class StreamDecoder:
+    """
+    Incremental decoder of data sent by WRH clients.
+    Protocol is negotiated from the first bytes of the connection:
+    * STREAM_MAGIC_NDJSON - newline-delimited JSON records, empty line closes a batch,
+    * STREAM_MAGIC_LENGTH_PREFIXED - records prefixed with 4-byte big-endian length, zero-length frame closes a batch,
+    * anything else - legacy protocol with single NUL-padded JSON object per connection.
+    End of stream closes the pending batch as well.
+    """
+    LEGACY, NDJSON, LENGTH_PREFIXED = 'legacy', 'ndjson', 'length_prefixed'
+    _MAGICS = {STREAM_MAGIC_NDJSON: NDJSON, STREAM_MAGIC_LENGTH_PREFIXED: LENGTH_PREFIXED}
+    _LENGTH = struct.Struct('>I')
+
+    def __init__(self):
+        self.mode = None
+        self.finished = False
+        self._buffer = bytearray()
+        self._pending = 0
+
+    def feed(self, data):
+        """
+        Consume received bytes.
+        :param data: chunk of bytes read from connection
+        :return: list of decoded records (dicts), INVALID markers and BATCH_END markers
+        :rtype: list
+        """
+        self._buffer.extend(data)
+        if not self.mode and not self._negotiate():
+            return []
+        events = getattr(self, f'_decode_{self.mode}')()
+        if len(self._buffer) > MAX_FRAME_SIZE:
+            raise ProtocolError(f'Frame exceeds {MAX_FRAME_SIZE} bytes')
+        return events
+
+    def close(self):
+        """
+        Signal end of stream.
+        :return: list of remaining events
+        :rtype: list
+        """
+        self.finished = True
+        if self.mode == self.NDJSON and self._buffer.strip():
+            self._buffer.extend(b'\n')
+            events = self._decode_ndjson()
+        elif self.mode in (self.NDJSON, self.LENGTH_PREFIXED):
+            events = []
+        else:
+            return [self._decode_record(self._buffer)] if self._buffer.strip(b'\0 \t\r\n') else []
+        if self._pending:
+            self._pending = 0
+            events.append(BATCH_END)
+        return events
+
+    def _negotiate(self):
+        for magic, mode in self._MAGICS.items():
+            if self._buffer.startswith(magic):
+                self.mode = mode
+                del self._buffer[:len(magic)]
+                return True
+            if magic.startswith(bytes(self._buffer)):
+                return False
+        self.mode = self.LEGACY
+        return True
+
+    def _decode_legacy(self):
+        try:
+            record = json.loads(self._buffer.decode('utf-8').replace('\0', ''))
+        except ValueError:
+            return []  # Probably incomplete, wait for more data
+        self.finished = True
+        self._buffer.clear()
+        return [record]
+
+    def _decode_ndjson(self):
+        events = []
+        *lines, rest = self._buffer.split(b'\n')
+        for line in lines:
+            events.append(self._end_batch() if not line.strip() else self._decode_record(line))
+        self._buffer = bytearray(rest)
+        return events
+
+    def _decode_length_prefixed(self):
+        events, offset, size = [], 0, self._LENGTH.size
+        while len(self._buffer) - offset >= size:
+            length, = self._LENGTH.unpack_from(self._buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f'Frame exceeds {MAX_FRAME_SIZE} bytes')
+            if len(self._buffer) - offset - size < length:
+                break
+            frame = self._buffer[offset + size:offset + size + length]
+            events.append(self._decode_record(frame) if length else self._end_batch())
+            offset += size + length
+        del self._buffer[:offset]
+        return events
+
+    def _decode_record(self, raw):
+        self._pending += 1
+        try:
+            return json.loads(bytes(raw).decode('utf-8').replace('\0', ''))
+        except ValueError:
+            return INVALID
+
+    def _end_batch(self):
+        self._pending = 0
+        return BATCH_END
+
+
+class IngestionStream:
+    """
+    Protocol state of single client connection.
+    Every decoded record is passed to record_handler; streaming modes reply with JSON acknowledgement line
+    ({"accepted": n, "rejected": m}) after every batch.
+    Record whose handler raises is counted as rejected, so one failing record never breaks the rest of its batch.
+    Accepted means queued for MeasurementWriter, not yet committed to database. Queued records are durable only
+    when the engine runs with spool (--spool); otherwise they are lost if the process dies or the database stays
+    unavailable, so clients must not rely on the acknowledgement to discard their buffered readings.
+    """
+
+    def __init__(self, record_handler):
+        """
+        :param record_handler: callable accepting decoded record and returning whether it has been accepted
+        """
+        self.record_handler = record_handler
+        self.decoder = StreamDecoder()
+        self.accepted = self.rejected = 0
+
+    @property
+    def finished(self):
+        return self.decoder.finished
+
+    def feed(self, chunk):
+        """
+        Process chunk of received data. Empty chunk means that client closed the connection.
+        :return: bytes that should be sent back to the client
+        :rtype: bytes
+        """
+        start = time.perf_counter()
+        events = self.decoder.feed(chunk) if chunk else self.decoder.close()
+        INGEST_DECODE_SECONDS.observe(time.perf_counter() - start)
+        replies = []
+        for event in events:
+            if event is BATCH_END:
+                replies.append(json.dumps({'accepted': self.accepted, 'rejected': self.rejected}).encode() + b'\n')
+                self.accepted = self.rejected = 0
+            elif event is not INVALID and self._handle(event):
+                self.accepted += 1
+            else:
+                if event is INVALID:
+                    INGEST_REJECTED.labels('invalid_json').inc()
+                self.rejected += 1
+        return b''.join(replies)
+
+    def _handle(self, record):
+        try:
+            return self.record_handler(record)
+        except Exception as e:
+            INGEST_REJECTED.labels('handler_error').inc()
+            log(f'Processing of record {record} failed: {e}', Color.FAIL)
+            return False
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+from collections import defaultdict, deque
+
+from db_engine.constants import LIVE_QUEUE_SIZE
+
+
+class Subscription:
+    """
+    Bounded queue of measurements of single module consumed on the event loop it was created on.
+    When consumer falls behind, oldest pending measurements are dropped and the rest is delivered in one batch.
+    """
+
+    def __init__(self, key, loop, queue_size=LIVE_QUEUE_SIZE):
+        self.key = key
+        self.loop = loop
+        self.dropped = 0
+        self._pending = deque(maxlen=queue_size)
+        self._ready = asyncio.Event()
+
+    def push(self, measurements):
+        """
+        Enqueue measurements. Safe to call from any thread.
+        """
+        self.loop.call_soon_threadsafe(self._push, measurements)
+
+    async def get(self):
+        """
+        Wait for new measurements and return all of them.
+        :rtype: list
+        """
+        await self._ready.wait()
+        self._ready.clear()
+        measurements = list(self._pending)
+        self._pending.clear()
+        return measurements
+
+    def _push(self, measurements):
+        self.dropped += max(len(self._pending) + len(measurements) - self._pending.maxlen, 0)
+        self._pending.extend(measurements)
+        self._ready.set()
+
+
+class MeasurementBroker:
+    """
+    Publish/subscribe bridge between ingestion threads and Tornado IOLoop.
+    Subscriptions are keyed on (module WRHID, client_id, module_id).
+    """
+
+    def __init__(self, queue_size=LIVE_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, wrhid, client_id, module_id):
+        """
+        Create subscription bound to currently running event loop.
+        :rtype: Subscription
+        """
+        subscription = Subscription((wrhid, client_id, module_id), asyncio.get_event_loop(), self.queue_size)
+        with self._lock:
+            self._subscriptions[subscription.key].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscriptions.get(subscription.key, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscriptions.pop(subscription.key, None)
+
+    def publish_packets(self, packets):
+        """
+        Deliver written measurements to subscribers of their modules.
+        :param packets: list of (client_id, packet) pairs
+        """
+        if not self._subscriptions:
+            return
+        measurements = defaultdict(list)
+        for client_id, packet in packets:
+            key = (packet['module_type'], client_id, packet['module_id'])
+            if key in self._subscriptions:
+                measurements[key].append({'date': packet.get('date'), 'measurement': packet.get('measurement')})
+        with self._lock:
+            targets = [(s, measurements[key]) for key in measurements for s in self._subscriptions.get(key, ())]
+        for subscription, batch in targets:
+            subscription.push(batch)
@@ -0,0 +1,223 @@
+import ast
+import hashlib
+import json
+import os
+import threading
+from importlib import import_module
+from os.path import join as pjoin
+
+from utils.io import log, Color
+
+MANIFEST_VERSION = 2
+
+
+class ModuleRegistry:
+    """
+    Lazily loaded registry of additional WRH modules (ModuleBase subclasses found in modules path).
+    Module files are not imported to find modules: WRHIDs and class names are read from their syntax trees and cached
+    in manifest file together with modification times of the files, so unchanged files are not even parsed again.
+    Only WRHID assigned a string literal in the class body (WRHID = '...' or WRHID: str = '...') is found this way.
+    File having a class without such WRHID which derives from ModuleBase, from a class imported from modules package
+    or from another class of the same file (e.g. inherits WRHID) is imported to find its modules instead.
+    Module class is imported the first time its WRHID is requested; iterating the registry imports all of them.
+    Load hooks (e.g. declaration of rollup tables) are run for every module class once it is imported.
+    """
+
+    def __init__(self, path, manifest_path, schema_files=()):
+        """
+        :param path: directory of additional WRH modules
+        :param manifest_path: file in which discovered modules are cached
+        :param schema_files: other files defining database schema, whose changes require schema update
+        """
+        self.path = path
+        self.manifest_path = manifest_path
+        self.schema_files = schema_files
+        self._lock = threading.RLock()
+        self._manifest = None
+        self._classes = {}
+        self._load_hooks = []
+
+    @property
+    def wrhids(self):
+        """
+        WRHIDs of all discovered modules (nothing is imported).
+        :rtype: list
+        """
+        return list(self._get_manifest()['modules'])
+
+    def get(self, wrhid, default=None):
+        """
+        :return: module class of given WRHID imported on first use, default when there is no such module
+        """
+        if wrhid in self._classes:
+            return self._classes[wrhid] or default
+        with self._lock:
+            return self._load(wrhid) or default
+
+    def add_load_hook(self, hook):
+        """
+        Call hook with every module class, immediately for already imported ones.
+        """
+        with self._lock:
+            self._load_hooks.append(hook)
+            for cls in (c for c in self._classes.values() if c):
+                hook(cls)
+
+    def fingerprint(self, *extra):
+        """
+        :return: digest of modification times of module and schema files (and extra values)
+        :rtype: str
+        """
+        files = self._get_manifest()['files']
+        stamps = sorted(files.items()) + [(f, os.stat(f).st_mtime_ns) for f in self.schema_files if os.path.exists(f)]
+        return hashlib.sha256(json.dumps([stamps, extra]).encode('utf-8')).hexdigest()
+
+    def get_schema(self, key):
+        """
+        :return: (fingerprint, table names) remembered with remember_schema for given database, or None
+        """
+        schema = self._get_manifest()['schemas'].get(key)
+        return (schema['fingerprint'], schema['tables']) if schema else None
+
+    def remember_schema(self, key, fingerprint, tables):
+        with self._lock:
+            self._get_manifest()['schemas'][key] = {'fingerprint': fingerprint, 'tables': sorted(tables)}
+            self._save_manifest()
+
+    def __contains__(self, wrhid):
+        if wrhid in self._classes:
+            return self._classes[wrhid] is not None
+        return wrhid in self._get_manifest()['modules']
+
+    def __iter__(self):
+        return iter([cls for cls in (self.get(wrhid) for wrhid in self.wrhids) if cls])
+
+    def __len__(self):
+        return len(self._get_manifest()['modules'])
+
+    def _load(self, wrhid):
+        if wrhid in self._classes:
+            return self._classes[wrhid]
+        location = self._get_manifest()['modules'].get(wrhid)
+        if not location:
+            return None
+        from db_engine import Base
+        from modules.base import ModuleBase
+        module_name, class_name = location
+        cls = getattr(import_module(module_name), class_name, None)
+        if not (isinstance(cls, type) and issubclass(cls, ModuleBase) and issubclass(cls, Base) and
+                getattr(cls, 'WRHID', None) == wrhid):
+            log(f'{module_name}.{class_name} is not a WRH module with WRHID {wrhid}, ignoring it', Color.WARNING)
+            cls = None
+        for hook in self._load_hooks if cls else ():
+            hook(cls)
+        self._classes[wrhid] = cls
+        return cls
+
+    def _get_manifest(self):
+        if self._manifest is None:
+            with self._lock:
+                if self._manifest is None:
+                    self._manifest = self._discover()
+        return self._manifest
+
+    def _discover(self):
+        cached = self._read_manifest()
+        files = self._module_files()
+        if cached and cached['files'] == files:
+            return cached
+        modules = {}
+        for file in files:
+            if cached and cached['files'].get(file) == files[file]:
+                found = {w: l for w, l in cached['modules'].items() if l[0] == self._module_name(file)}
+            else:
+                found = self._scan_file(file)
+            for wrhid in (w for w in found if w in modules):
+                log(f'WRHID {wrhid} is declared more than once, using {found[wrhid]}', Color.WARNING)
+            modules.update(found)
+        log('Following additional db models have been found: \n*{}'.format(
+            '\n*'.join(f'{m}.{c}' for m, c in modules.values())), Color.BLUE)
+        manifest = {'version': MANIFEST_VERSION, 'files': files, 'modules': modules,
+                    'schemas': cached['schemas'] if cached else {}}
+        self._manifest = manifest
+        self._save_manifest()
+        return manifest
+
+    def _module_files(self):
+        if not os.path.exists(self.path):
+            log(f'Path {self.path} for additional WRH modules does not exist')
+            return {}
+        files = {}
+        for mdir in (e for e in sorted(os.listdir(self.path)) if e[0] != '.' and os.path.isdir(pjoin(self.path, e))):
+            _path = pjoin(self.path, mdir)
+            if '__init__.py' not in os.listdir(_path): continue
+            for f in sorted(os.listdir(_path)):
+                if f[0] != '.' and f != '__init__.py' and f[-3:] == '.py':
+                    files[pjoin(_path, f)] = os.stat(pjoin(_path, f)).st_mtime_ns
+        return files
+
+    def _scan_file(self, file):
+        with open(file, 'r') as f:
+            tree = ast.parse(f.read(), filename=file)
+        classes = [n for n in tree.body if isinstance(n, ast.ClassDef)]
+        imported = {a.asname or a.name for n in tree.body if isinstance(n, ast.ImportFrom) and
+                    (n.module or '').startswith('modules') for a in n.names}
+        possible_bases = {'ModuleBase', *imported, *(n.name for n in classes)}
+        modules = {}
+        for node in classes:
+            wrhid = next((w for w in map(self._literal_wrhid, node.body) if w), None)
+            if wrhid:
+                modules[wrhid] = [self._module_name(file), node.name]
+            elif any(self._name_of(b) in possible_bases for b in node.bases):
+                return self._import_file(file)
+        return modules
+
+    def _import_file(self, file):
+        from db_engine import Base
+        from modules.base import ModuleBase
+        module_name = self._module_name(file)
+        return {cls.WRHID: [module_name, name] for name, cls in vars(import_module(module_name)).items()
+                if isinstance(cls, type) and issubclass(cls, ModuleBase) and issubclass(cls, Base) and
+                cls.__module__ == module_name and getattr(cls, 'WRHID', None)}
+
+    @staticmethod
+    def _literal_wrhid(statement):
+        # ast.literal_eval handles string literals of all Python versions (ast.Str before 3.8, ast.Constant since)
+        if isinstance(statement, ast.Assign):
+            targets = statement.targets
+        elif isinstance(statement, ast.AnnAssign) and statement.value is not None:
+            targets = [statement.target]
+        else:
+            return None
+        if 'WRHID' not in (t.id for t in targets if isinstance(t, ast.Name)):
+            return None
+        try:
+            value = ast.literal_eval(statement.value)
+        except (ValueError, TypeError):
+            return None
+        return value if isinstance(value, str) and value else None
+
+    @staticmethod
+    def _name_of(node):
+        return node.id if isinstance(node, ast.Name) else getattr(node, 'attr', None)
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.loads(f.read())
+        except (IOError, ValueError):
+            return None
+        return manifest if manifest.get('version') == MANIFEST_VERSION else None
+
+    def _save_manifest(self):
+        temporary = f'{self.manifest_path}.{os.getpid()}'
+        try:
+            with open(temporary, 'w') as f:
+                f.write(json.dumps(self._manifest))
+            os.replace(temporary, self.manifest_path)
+        except IOError as e:
+            log(f'Unable to write WRH modules manifest {self.manifest_path}: {e}', Color.WARNING)
+
+    @staticmethod
+    def _module_name(file):
+        return file.replace(os.sep, '.')[:-3]
@@ -0,0 +1,159 @@
+import json
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from db_engine.constants import RETENTION_CONFIG_FILE, RETENTION_INTERVAL, RETENTION_BATCH_SIZE, RETENTION_BATCH_PAUSE
+from db_engine.models import Measurement, Module
+from db_engine.rollups import RAW, HOURLY, DAILY, has_rollups, get_rollup_table
+from utils.io import log, Color
+
+
+class RetentionPolicy:
+    """
+    Per-table retention of measurements, persisted in RETENTION_CONFIG_FILE:
+        {"tables": {"measurement_dht22": {"raw": 30, "hourly": 365}}, "drop_generic_copies": true}
+    Numbers are days for which rows of given resolution are kept; missing resolutions are kept forever.
+    Once raw rows are gone, older data of modules with rollups is still available in hourly and daily rollups.
+    With drop_generic_copies, rows of the generic measurement table are removed as soon as the same measurement
+    (client_id, module_id, timestamp) is stored in a dedicated module table.
+    """
+    RESOLUTIONS = (RAW, HOURLY, DAILY)
+
+    def __init__(self, tables=None, drop_generic_copies=False):
+        self.tables = tables or {}
+        self.drop_generic_copies = drop_generic_copies
+
+    @classmethod
+    def load(cls, path=RETENTION_CONFIG_FILE):
+        try:
+            with open(path, 'r') as f:
+                configuration = json.loads(f.read())
+        except FileNotFoundError:
+            return cls()
+        except (IOError, ValueError) as e:
+            log(f'Unable to read retention policy from {path} ({e}), keeping all measurements', Color.WARNING)
+            return cls()
+        return cls(configuration.get('tables'), configuration.get('drop_generic_copies', False))
+
+    def save(self, path=RETENTION_CONFIG_FILE):
+        with open(path, 'w') as f:
+            f.write(json.dumps({'tables': self.tables, 'drop_generic_copies': self.drop_generic_copies}, indent=4))
+
+    def days(self, table_name, resolution):
+        """
+        :return: number of days rows of given resolution are kept for, None meaning forever
+        """
+        return self.tables.get(table_name, {}).get(resolution) or None
+
+    def set_days(self, table_name, resolution, days):
+        policy = self.tables.setdefault(table_name, {})
+        if days:
+            policy[resolution] = days
+        else:
+            policy.pop(resolution, None)
+
+    def apply_to(self, module):
+        """
+        Let module know which resolutions are retained, so it does not query data which are already removed.
+        """
+        module.retention = {r: self.days(module.__tablename__, r) for r in self.RESOLUTIONS}
+
+
+class RetentionJob:
+    """
+    Background job enforcing RetentionPolicy every interval seconds.
+    Rows are deleted in transactions of at most batch_size rows separated by short pauses, so that ingestion
+    and dashboards are never blocked for long. Expired rows are looked up module by module, so every batch is
+    an index range scan of (client_id, module_id, timestamp) instead of a scan of the whole table.
+    """
+
+    def __init__(self, sessionmaker, policy, wrh_modules, interval=RETENTION_INTERVAL, batch_size=RETENTION_BATCH_SIZE,
+                 pause=RETENTION_BATCH_PAUSE):
+        self.sessionmaker = sessionmaker
+        self.policy = policy
+        self.wrh_modules = wrh_modules
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self._should_end = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not self._thread:
+            self._should_end.clear()
+            self._thread = threading.Thread(target=self._run, name='RetentionJob', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._should_end.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self):
+        """
+        Enforce the policy on all tables.
+        :return: number of deleted rows
+        :rtype: int
+        """
+        if not self.policy.tables and not self.policy.drop_generic_copies:
+            return 0
+        deleted, modules = 0, self._modules()
+        for table in [Measurement.__table__] + [m.__table__ for m in self.wrh_modules]:
+            for resolution in self.policy.RESOLUTIONS:
+                days = self.policy.days(table.name, resolution)
+                if days and (resolution == RAW or has_rollups(table)):
+                    target = table if resolution == RAW else get_rollup_table(table, resolution)
+                    deleted += self._delete_older(target, 'timestamp' if resolution == RAW else 'bucket', days,
+                                                  modules)
+            if self.policy.drop_generic_copies and table is not Measurement.__table__:
+                deleted += self._delete_in_batches(f"""
+                    SELECT g.id FROM {Measurement.__tablename__} g JOIN {table.name} d
+                    ON d.client_id = g.client_id AND d.module_id = g.module_id AND d.timestamp = g.timestamp
+                    """, Measurement.__tablename__, 'id')
+        return deleted
+
+    def _run(self):
+        while not self._should_end.is_set():
+            try:
+                deleted = self.run_once()
+                if deleted:
+                    log(f'Retention policy removed {deleted} rows')
+            except Exception as e:
+                log(f'Enforcing retention policy failed: {e}', Color.FAIL)
+            self._should_end.wait(self.interval)
+
+    def _modules(self):
+        session = self.sessionmaker()
+        try:
+            return session.execute(text(f'SELECT client_id, id FROM {Module.__tablename__}')).fetchall()
+        finally:
+            session.close()
+
+    def _delete_older(self, table, column, days, modules):
+        key = ', '.join(c.name for c in table.primary_key.columns)
+        cutoff = datetime.now() - timedelta(days=days)
+        select = f'SELECT {key} FROM {table.name} ' \
+                 f'WHERE client_id = :client_id AND module_id = :module_id AND {column} < :cutoff'
+        return sum(self._delete_in_batches(select, table.name, key,
+                                           {'client_id': client_id, 'module_id': module_id, 'cutoff': cutoff})
+                   for client_id, module_id in modules)
+
+    def _delete_in_batches(self, select, table_name, key, params=None):
+        # Row values are compared for composite keys of rollup tables
+        statement = text(f'DELETE FROM {table_name} WHERE ({key}) IN ({select} LIMIT :limit)')
+        deleted = 0
+        while not self._should_end.is_set():
+            session = self.sessionmaker()
+            try:
+                count = session.execute(statement, dict(params or {}, limit=self.batch_size)).rowcount
+                session.commit()
+            finally:
+                session.close()
+            deleted += count
+            if count < self.batch_size:
+                break
+            self._should_end.wait(self.pause)
+        return deleted
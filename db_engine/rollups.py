@@ -0,0 +1,119 @@
+from collections import defaultdict
+
+from sqlalchemy import Column, Integer, TIMESTAMP, Float, Table, func, text
+from sqlalchemy.dialects import postgresql
+
+from db_engine import Base
+
+RAW, HOURLY, DAILY = 'raw', 'hourly', 'daily'
+ROLLUP_RESOLUTIONS = {HOURLY: 'hour', DAILY: 'day'}  # resolution -> date_trunc field
+_TRUNCATE = {HOURLY: lambda ts: ts.replace(minute=0, second=0, microsecond=0),
+             DAILY: lambda ts: ts.replace(hour=0, minute=0, second=0, microsecond=0)}
+_AGGREGATES = ('sum', 'count', 'min', 'max')
+_rollups = {}  # source table name -> (aggregated columns, {resolution: rollup table})
+
+
+def declare_rollups(source_table, columns):
+    """
+    Declare hourly and daily rollup tables for numeric columns of the source table.
+    Every rollup table stores sum, count, min and max of each column per (client_id, module_id, bucket).
+    :param source_table: raw measurements table
+    :param columns: names of aggregated columns
+    :return: rollup tables keyed by resolution
+    :rtype: dict
+    """
+    if source_table.name not in _rollups:
+        tables = {}
+        for resolution in ROLLUP_RESOLUTIONS:
+            aggregated = (_aggregate_column(c, a) for c in columns for a in _AGGREGATES)
+            tables[resolution] = Table(f'{source_table.name}_{resolution}', Base.metadata,
+                                       Column('client_id', Integer, primary_key=True),
+                                       Column('module_id', Integer, primary_key=True),
+                                       Column('bucket', TIMESTAMP, primary_key=True),
+                                       *aggregated)
+        _rollups[source_table.name] = (tuple(columns), tables)
+    return _rollups[source_table.name][1]
+
+
+def get_rollup_table(source_table, resolution):
+    return _rollups[source_table.name][1][resolution]
+
+
+def has_rollups(source_table):
+    return source_table.name in _rollups
+
+
+def update_rollups(session, source_table, rows):
+    """
+    Incrementally merge freshly inserted raw rows into rollup tables of their source table.
+    Rows are pre-aggregated in memory, so every touched bucket costs single upserted row per resolution.
+    """
+    if source_table.name not in _rollups or session.bind.dialect.name != 'postgresql':
+        return
+    columns, tables = _rollups[source_table.name]
+    for resolution, table in tables.items():
+        buckets = defaultdict(lambda: {f'{c}_{a}': 0 if a in ('sum', 'count') else None
+                                       for c in columns for a in _AGGREGATES})
+        for row in rows:
+            bucket = buckets[(row['client_id'], row['module_id'], _TRUNCATE[resolution](row['timestamp']))]
+            for c in (c for c in columns if row.get(c) is not None):
+                value = float(row[c])
+                bucket[f'{c}_sum'] += value
+                bucket[f'{c}_count'] += 1
+                bucket[f'{c}_min'] = value if bucket[f'{c}_min'] is None else min(bucket[f'{c}_min'], value)
+                bucket[f'{c}_max'] = value if bucket[f'{c}_max'] is None else max(bucket[f'{c}_max'], value)
+        session.execute(_merge_statement(table, columns),
+                        [dict(client_id=c, module_id=m, bucket=b, **v) for (c, m, b), v in buckets.items()])
+
+
+def rebuild_rollups(session, source_table, from_date=None, until_date=None):
+    """
+    Recompute rollup buckets of the source table from raw rows (periodic compaction and backfill).
+    :param from_date: beginning of rebuilt window, None meaning whole history
+    :param until_date: end of rebuilt window (exclusive), None meaning now
+    """
+    columns, tables = _rollups[source_table.name]
+    aggregates = ', '.join(f'coalesce({a}({c}), 0)' if a in ('sum', 'count') else f'{a}({c})'
+                           for c in columns for a in _AGGREGATES)
+    for resolution, table in tables.items():
+        params = {'field': ROLLUP_RESOLUTIONS[resolution], 'from_date': from_date, 'until_date': until_date}
+        session.execute(text(f'DELETE FROM {table.name} WHERE {_window("bucket", from_date, until_date)}'), params)
+        session.execute(text(f"""
+            INSERT INTO {table.name} (client_id, module_id, bucket, {', '.join(_aggregate_names(columns))})
+            SELECT client_id, module_id, date_trunc(:field, timestamp) AS bucket, {aggregates}
+            FROM {source_table.name}
+            WHERE {_window('timestamp', from_date, until_date)}
+            GROUP BY client_id, module_id, bucket
+            """), params)
+
+
+def _window(column, from_date, until_date):
+    # Window edges are aligned to whole buckets, so rebuilt buckets are never partial
+    conditions = ['TRUE']
+    if from_date:
+        conditions.append(f'{column} >= date_trunc(:field, CAST(:from_date AS TIMESTAMP))')
+    if until_date:
+        conditions.append(f'{column} < date_trunc(:field, CAST(:until_date AS TIMESTAMP))')
+    return ' AND '.join(conditions)
+
+
+def _aggregate_column(column, aggregate):
+    name = f'{column}_{aggregate}'
+    if aggregate in ('sum', 'count'):
+        return Column(name, Integer if aggregate == 'count' else Float, nullable=False, server_default=text('0'))
+    return Column(name, Float)
+
+
+def _aggregate_names(columns):
+    return [f'{c}_{a}' for c in columns for a in _AGGREGATES]
+
+
+def _merge_statement(table, columns):
+    statement = postgresql.insert(table)
+    excluded, set_ = statement.excluded, {}
+    for c in columns:
+        for a in ('sum', 'count'):
+            set_[f'{c}_{a}'] = table.c[f'{c}_{a}'] + excluded[f'{c}_{a}']
+        set_[f'{c}_min'] = func.least(table.c[f'{c}_min'], excluded[f'{c}_min'])
+        set_[f'{c}_max'] = func.greatest(table.c[f'{c}_max'], excluded[f'{c}_max'])
+    return statement.on_conflict_do_update(index_elements=('client_id', 'module_id', 'bucket'), set_=set_)
@@ -0,0 +1,87 @@
+import hashlib
+
+from sqlalchemy import Index, inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from db_engine import Base, WRH_MODULES
+from db_engine.rollups import has_rollups, rebuild_rollups
+from utils.io import log, Color
+
+
+def ensure_schema(engine, brin=False):
+    """
+    Create missing tables and indexes unless schema of this database has already been prepared from the very same
+    module and schema files (see ModuleRegistry.fingerprint) and all its tables still exist.
+    All WRH modules are imported only when schema has to be updated.
+    :param engine: database engine
+    :param brin: see ensure_indexes
+    :return: whether schema has been updated
+    :rtype: bool
+    """
+    key = hashlib.sha256(repr(engine.url).encode('utf-8')).hexdigest()
+    fingerprint = WRH_MODULES.fingerprint(brin)
+    prepared = WRH_MODULES.get_schema(key)
+    if prepared and prepared[0] == fingerprint and set(prepared[1]) <= set(inspect(engine).get_table_names()):
+        return False
+    list(WRH_MODULES)  # Importing modules declares their tables
+    Base.metadata.create_all(engine)
+    ensure_indexes(engine, brin=brin)
+    WRH_MODULES.remember_schema(key, fingerprint, Base.metadata.tables.keys())
+    return True
+
+
+def ensure_indexes(engine, brin=False):
+    """
+    Create indexes declared in models which are missing in already existing tables
+    (create_all creates indexes only together with new tables).
+    Unique index which cannot be created because of already stored duplicates is created after removing them
+    (the oldest row of every duplicated key is kept). Any index which still cannot be created raises,
+    so schema is not remembered as prepared.
+    Non-unique ix_* index superseded by unique ux_* index on the same columns is dropped once the unique one exists,
+    so inserts do not maintain both.
+    :param engine: database engine
+    :param brin: whether BRIN indexes on timestamp columns of raw measurement tables should be created as well
+    (PostgreSQL only); they are tiny and fit append-only, time-ordered tables well
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        indexes = list(table.indexes)
+        if brin and engine.dialect.name == 'postgresql' and 'timestamp' in table.c:
+            indexes.append(_brin_index(table))
+        for index in (i for i in indexes if i.name not in existing):
+            log(f'Creating missing index {index.name}')
+            try:
+                index.create(bind=engine)
+            except SQLAlchemyError as e:
+                if not index.unique or len(table.primary_key.columns) != 1:
+                    raise
+                log(f'Unable to create unique index {index.name}, removing duplicated rows: {e}', Color.WARNING)
+                _create_deduplicated(engine, table, index)
+            existing.add(index.name)
+        for index in (i for i in indexes if i.unique and i.name.startswith('ux_') and i.name in existing):
+            superseded = f'ix_{index.name[3:]}'
+            if superseded in existing:
+                log(f'Dropping index {superseded} superseded by {index.name}')
+                with engine.begin() as connection:
+                    connection.execute(text(f'DROP INDEX {superseded}'))
+
+
+def _create_deduplicated(engine, table, index):
+    primary_key = next(iter(table.primary_key.columns)).name
+    key = ', '.join(c.name for c in index.columns)
+    with engine.begin() as connection:
+        removed = connection.execute(text(f"""
+            DELETE FROM {table.name}
+            WHERE {primary_key} NOT IN (SELECT min({primary_key}) FROM {table.name} GROUP BY {key})
+            """)).rowcount
+        log(f'Removed {removed} duplicated rows from {table.name}', Color.WARNING)
+        index.create(bind=connection)
+        if has_rollups(table) and engine.dialect.name == 'postgresql':
+            rebuild_rollups(connection, table)  # Rollups still count removed duplicates
+
+
+def _brin_index(table):
+    name = f'ix_{table.name}_timestamp_brin'
+    return next((i for i in table.indexes if i.name == name), None) or \
+        Index(name, table.c.timestamp, postgresql_using='brin')
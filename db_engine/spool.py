@@ -0,0 +1,247 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from db_engine.constants import SPOOL_SEGMENT_SIZE, SPOOL_READ_CHUNK, WRITER_QUEUE_SIZE, WRITER_QUEUE_PUT_TIMEOUT
+from utils.io import log, Color
+
+
+class MemoryQueue:
+    """
+    In-memory queue of measurements waiting for MeasurementWriter; queued measurements are lost on crash.
+    Queue is bounded: while it is full (database is slow or down), put blocks ingestion for up to put_timeout
+    seconds, so backpressure reaches the sockets, and then raises queue.Full.
+    """
+
+    def __init__(self, maxsize=WRITER_QUEUE_SIZE, put_timeout=WRITER_QUEUE_PUT_TIMEOUT):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.put_timeout = put_timeout
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def put(self, record):
+        self._queue.put(record, timeout=self.put_timeout)
+
+    def get_batch(self, max_records, timeout):
+        """
+        Wait up to timeout seconds until max_records records are gathered.
+        :return: (records, position) pair; position should be passed to commit() once records are stored
+        """
+        batch, deadline = [], time.monotonic() + timeout
+        while len(batch) < max_records:
+            try:
+                remaining = deadline - time.monotonic()
+                batch.append(self._queue.get(block=remaining > 0, timeout=max(remaining, 0)))
+            except queue.Empty:
+                break
+        return batch, None
+
+    def commit(self, position):
+        pass
+
+    def rewind(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Spool:
+    """
+    Durable queue of measurements: append-only log of JSON lines split into numbered segment files.
+    Records are acknowledged with commit() only after they are stored in database; position of the first
+    uncommitted record is persisted in checkpoint file, so after crash or restart everything from that position
+    is replayed (at-least-once delivery). Fully committed segments are removed.
+    Appends are flushed to the operating system immediately and synced to disk when segment is closed.
+    Files are opened lazily, so instance may be created in processes which never use it.
+    """
+    SUFFIX = '.log'
+    CHECKPOINT = 'checkpoint'
+
+    def __init__(self, directory, segment_size=SPOOL_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._condition = threading.Condition()
+        self._writer = self._reader = None
+        self._write_segment = self._read_segment = None
+        self._read_offset = 0
+        self._committed = None
+        self._depth = self._unread = self._read = 0
+
+    @property
+    def depth(self):
+        return self._depth
+
+    def put(self, record):
+        line = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+        with self._condition:
+            self._ensure_open()
+            self._writer.write(line)
+            self._writer.flush()
+            self._depth += 1
+            self._unread += 1
+            if self._writer.tell() >= self.segment_size:
+                self._open_segment(self._write_segment + 1)
+            self._condition.notify()
+
+    def get_batch(self, max_records, timeout):
+        """
+        Wait up to timeout seconds for unread records and return at most max_records of them.
+        :return: (records, position) pair; position should be passed to commit() once records are stored
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._ensure_open()
+            while not self._unread and self._condition.wait(max(deadline - time.monotonic(), 0)):
+                pass
+            records = []
+            while len(records) < max_records and self._unread:
+                line = self._reader.readline()
+                if line.endswith(b'\n'):
+                    self._read_offset += len(line)
+                    self._unread -= 1
+                    self._read += 1
+                    record = self._decode(line)
+                    if record:
+                        records.append(record)
+                elif self._read_segment < self._write_segment:
+                    self._open_reader(self._next_segment(self._read_segment), 0)
+                else:
+                    break
+            return records, (self._read_segment, self._read_offset)
+
+    def commit(self, position):
+        """
+        Acknowledge all records read so far and persist position returned with the last batch as the replay point.
+        """
+        with self._condition:
+            self._depth -= self._read
+            self._read = 0
+            self._committed = position
+            self._write_checkpoint(position)
+            for segment in (s for s in self._segments() if s < position[0]):
+                os.remove(self._path(segment))
+
+    def rewind(self):
+        """
+        Forget reads since the last commit, so that uncommitted records are returned by get_batch again.
+        """
+        with self._condition:
+            self._unread, self._read = self._depth, 0
+            self._open_reader(*self._committed)
+
+    def close(self):
+        with self._condition:
+            if self._writer:
+                self._writer.flush()
+                os.fsync(self._writer.fileno())
+                self._writer.close()
+                self._reader.close()
+            self._writer = self._reader = None
+
+    def remove(self):
+        """
+        Delete files of closed spool whose records are all committed; directory itself is removed when empty.
+        """
+        with self._condition:
+            for segment in self._segments():
+                os.remove(self._path(segment))
+            for path in (os.path.join(self.directory, f) for f in (self.CHECKPOINT, f'{self.CHECKPOINT}.tmp')):
+                if os.path.exists(path):
+                    os.remove(path)
+            try:
+                os.rmdir(self.directory)
+            except OSError:
+                pass  # Contains spools of prefork workers
+
+    def _ensure_open(self):
+        if self._writer:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self._segments()
+        self._open_segment((segments[-1] + 1) if segments else 0)
+        self._committed = self._read_checkpoint(segments) or (self._write_segment, 0)
+        self._depth = self._unread = self._count_records(*self._committed, segments)
+        if self._depth:
+            log(f'Replaying {self._depth} measurements spooled in {self.directory}', Color.BLUE)
+        self._open_reader(*self._committed)
+
+    def _open_segment(self, segment):
+        if self._writer:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._writer.close()
+        self._writer = open(self._path(segment), 'ab')
+        self._write_segment = segment
+
+    def _open_reader(self, segment, offset):
+        if self._reader:
+            self._reader.close()
+        self._reader = open(self._path(segment), 'rb')
+        self._reader.seek(offset)
+        self._read_segment, self._read_offset = segment, offset
+
+    def _next_segment(self, segment):
+        return min(s for s in self._segments() if s > segment)
+
+    def _count_records(self, segment, offset, segments):
+        count = 0
+        for s in (s for s in segments if s >= segment):
+            with open(self._path(s), 'rb') as f:
+                f.seek(offset if s == segment else 0)
+                count += sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(SPOOL_READ_CHUNK), b''))
+        return count
+
+    def _read_checkpoint(self, segments):
+        try:
+            with open(os.path.join(self.directory, self.CHECKPOINT), 'r') as f:
+                segment, offset = (int(v) for v in f.read().split())
+        except (IOError, ValueError):
+            segment, offset = None, 0
+        if segment not in segments:
+            return (segments[0], 0) if segments else None
+        return segment, offset
+
+    def _write_checkpoint(self, position):
+        path = os.path.join(self.directory, self.CHECKPOINT)
+        with open(f'{path}.tmp', 'w') as f:
+            f.write('{} {}'.format(*position))
+        os.replace(f'{path}.tmp', path)
+
+    def _segments(self):
+        return sorted(int(f[:-len(self.SUFFIX)]) for f in os.listdir(self.directory) if f.endswith(self.SUFFIX))
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f'{segment:012d}{self.SUFFIX}')
+
+    @classmethod
+    def find_orphaned(cls, root, used):
+        """
+        Find spools left by previous runs which no writer of this run uses, e.g. those of prefork workers after restart
+        with fewer workers or after switching between prefork and single-process mode.
+        :param root: spool directory; single-process mode spools directly into it, prefork workers into its
+        numbered subdirectories
+        :param used: directories spooled into by writers of this run
+        :return: directories holding spool segments which are not used
+        :rtype: list
+        """
+        if not os.path.isdir(root):
+            return []
+        used = {os.path.normpath(d) for d in used}
+        candidates = [root] + [os.path.join(root, e) for e in sorted(os.listdir(root))
+                               if os.path.isdir(os.path.join(root, e))]
+        return [d for d in candidates
+                if os.path.normpath(d) not in used and any(f.endswith(cls.SUFFIX) for f in os.listdir(d))]
+
+    @staticmethod
+    def _decode(line):
+        try:
+            enqueued_at, client_id, packet = json.loads(line)
+        except ValueError:
+            log(f'Skipping corrupted spooled measurement {line!r}', Color.FAIL)
+            return None
+        return enqueued_at, client_id, packet
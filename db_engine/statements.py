@@ -0,0 +1,45 @@
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+def upsert(session, model, values, index_elements, update_columns):
+    """
+    Insert row or update existing one in a single statement (INSERT ... ON CONFLICT DO UPDATE), which is safe against
+    concurrent inserts of the same key. Dialects without ON CONFLICT support fall back to ORM merge.
+    :param session: database session
+    :param model: ORM model class
+    :param values: dictionary of column values
+    :param index_elements: names of columns forming the conflicting unique key
+    :param update_columns: names of columns overwritten when row already exists
+    """
+    dialect = session.bind.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        statement = {'postgresql': postgresql, 'sqlite': sqlite}[dialect].insert(model.__table__).values(**values)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=index_elements, set_={c: getattr(statement.excluded, c) for c in update_columns}))
+    else:
+        session.merge(model(**values))
+
+
+def insert_ignoring_duplicates(session, table, rows, returning=False):
+    """
+    Insert rows skipping those violating unique indexes (INSERT ... ON CONFLICT DO NOTHING).
+    Dialects without ON CONFLICT support use plain INSERT.
+    :param session: database session
+    :param table: target table
+    :param rows: list of dictionaries of column values, all having the same keys
+    :param returning: whether only actually inserted rows should be returned (PostgreSQL, and SQLite supporting
+    RETURNING; otherwise all rows are returned)
+    :return: list of inserted rows
+    """
+    dialect = session.bind.dialect.name
+    if returning and (dialect == 'postgresql' or
+                      (dialect == 'sqlite' and getattr(session.bind.dialect, 'insert_returning', False))):
+        statement = {'postgresql': postgresql, 'sqlite': sqlite}[dialect].insert(table).values(rows)
+        result = session.execute(statement.on_conflict_do_nothing().returning(*(table.c[k] for k in rows[0])))
+        return [dict(r._mapping) for r in result]
+    if dialect in ('postgresql', 'sqlite'):
+        session.execute({'postgresql': postgresql, 'sqlite': sqlite}[dialect].insert(table).on_conflict_do_nothing(),
+                        rows)
+    else:
+        session.execute(table.insert(), rows)
+    return rows
@@ -0,0 +1,116 @@
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+from db_engine.constants import EVENTS_QUEUE_SIZE, WORKERS_SHUTDOWN_TIMEOUT, METRICS_SNAPSHOT_INTERVAL
+from db_engine.engine import DBEngine
+from db_engine.metrics import REGISTRY, MetricsSnapshot
+from utils.io import log, Color
+
+
+class Supervisor:
+    """
+    Prefork mode: runs given number of ingestion processes sharing the listening port (SO_REUSEPORT) and single
+    process serving Tornado UI.
+    Measurements left in spools of previous runs which are not used by workers of this run are stored before forking.
+    Measurements stored by ingestion workers are forwarded to the UI process, so its caches and live views stay
+    up to date. Workers also send snapshots of their metrics every METRICS_SNAPSHOT_INTERVAL seconds, which are
+    merged into /metrics served by the UI process.
+    SIGINT and SIGTERM are forwarded to all workers, which flush their writers before exiting.
+    """
+
+    def __init__(self, workers, port, tornado_port, use_asyncio=False, spool_dir=None, **engine_kwargs):
+        self.workers = workers
+        self.spool_dir = spool_dir
+        self.port = port
+        self.tornado_port = tornado_port
+        self.engine_kwargs = dict(engine_kwargs, use_asyncio=use_asyncio)
+        self._processes = []
+        self._should_end = False
+
+    def run(self):
+        self._prepare_database()
+        context = multiprocessing.get_context('fork')
+        events = context.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self._processes = [context.Process(target=self._run_ui, args=(events,), name='wrh-ui')]
+        self._processes.extend(context.Process(target=self._run_ingestion, args=(events, i), name=f'wrh-ingestion-{i}')
+                               for i in range(self.workers))
+        signal.signal(signal.SIGINT, self._signal_handler)
+        signal.signal(signal.SIGTERM, self._signal_handler)
+        [p.start() for p in self._processes]
+        log(f'Started {self.workers} ingestion worker(s) and UI worker', Color.BLUE)
+        try:
+            while not self._should_end and all(p.is_alive() for p in self._processes):
+                self._processes[0].join(timeout=1)
+            if not self._should_end:
+                log('One of the workers exited unexpectedly, stopping the rest', Color.FAIL)
+        finally:
+            self._stop_workers(events)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    def _prepare_database(self):
+        # Schema creation and rollup backfill are done once, before forking, so that workers do not race
+        engine = DBEngine(self.port, self.tornado_port)
+        if engine.schema_updated:
+            engine.backfill_rollups()
+        engine.drain_spools([self._spool_dir(i) for i in range(self.workers)] if self.spool_dir else [])
+        engine.db_engine.dispose()
+
+    def _run_ingestion(self, events, index):
+        events.cancel_join_thread()  # Never block worker shutdown on notifications UI worker will not read anyway
+        engine = DBEngine(self.port, self.tornado_port, reuse_port=True, create_schema=False,
+                          spool_dir=self._spool_dir(index) if self.spool_dir else None, **self.engine_kwargs)
+        engine.writer.add_listener(lambda packets: self._forward(events, packets))
+        threading.Thread(target=self._send_metrics, args=(events, index), name='MetricsSender', daemon=True).start()
+        engine.start_work(serve_ui=False, backfill=False, retention=index == 0)
+
+    def _spool_dir(self, index):
+        return os.path.join(self.spool_dir, str(index))
+
+    def _run_ui(self, events):
+        DBEngine(self.port, self.tornado_port, create_schema=False, **self.engine_kwargs).serve_ui(events)
+
+    @staticmethod
+    def _forward(events, packets):
+        try:
+            events.put_nowait(packets)
+        except queue.Full:
+            log(f'UI worker is not keeping up, {len(packets)} measurements will not be pushed to it', Color.WARNING)
+
+    @staticmethod
+    def _send_metrics(events, index):
+        while True:
+            time.sleep(METRICS_SNAPSHOT_INTERVAL)
+            try:
+                events.put_nowait(MetricsSnapshot(f'wrh-ingestion-{index}', REGISTRY.snapshot()))
+            except queue.Full:
+                pass  # Next snapshot replaces this one anyway
+
+    def _signal_handler(self, *_):
+        self._should_end = True
+
+    def _stop_workers(self, events):
+        ui, ingestion = self._processes[0], self._processes[1:]
+        self._signal_all(ingestion)
+        self._join_all(ingestion)
+        events.put(None)
+        self._signal_all([ui])
+        self._join_all([ui])
+        log('All workers stopped')
+
+    @staticmethod
+    def _signal_all(processes):
+        for process in (p for p in processes if p.is_alive()):
+            os.kill(process.pid, signal.SIGINT)
+
+    @staticmethod
+    def _join_all(processes):
+        for process in processes:
+            process.join(timeout=WORKERS_SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                log(f'Worker {process.name} did not stop in time, terminating it', Color.WARNING)
+                process.terminate()
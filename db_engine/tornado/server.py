@@ -1,69 +1,141 @@
 import asyncio
+import json
 import os
-from datetime import datetime, timedelta
+import time
 
 import tornado
+from tornado.ioloop import IOLoop
 from tornado.web import RequestHandler
-from tornado_sqlalchemy import as_future
+from tornado.websocket import WebSocketHandler, WebSocketClosedError
 
 from db_engine import WRH_MODULES
-from db_engine.models import Module
-from db_engine.overlord_decorators import with_session
+from db_engine.constants import COMPRESSION_MIN_LENGTH
+from db_engine.metrics import REGISTRY, HTTP_REQUEST_SECONDS
+from db_engine.overlord_decorators import with_async_session
 from utils.io import log
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-class BaseWrhForm(RequestHandler):
-    MODULES_CACHE_TIME = timedelta(minutes=10)
-    last_modules_update = modules = installed_module_types = None
-    module_class_by_wrhid = {c.WRHID: c for c in WRH_MODULES}
 
-    def initialize(self, sessionmaker):
-        self.sessionmaker = sessionmaker
+class BaseWrhForm(RequestHandler):
+    module_class_by_wrhid = WRH_MODULES  # Module classes are imported on first request
 
-    async def prepare(self):
+    def initialize(self, async_sessionmaker, module_cache, response_cache):
         # TODO: Check that incoming connections are are only from within VPN!
-        if not self.last_modules_update or abs(datetime.now() - self.last_modules_update) > self.MODULES_CACHE_TIME:
-            log('Invalidating cached modules list and syncing new one')
-            BaseWrhForm.last_modules_update = datetime.now()
-            BaseWrhForm.modules = await self._get_modules()
-            BaseWrhForm.installed_module_types = list({m.type for m in self.modules})
+        self.async_sessionmaker = async_sessionmaker
+        self.module_cache = module_cache
+        self.response_cache = response_cache
 
-    @with_session
-    async def _get_modules(self, session):
-        return await asyncio.wrap_future(as_future(session.query(Module).all))
+    async def get_modules(self):
+        # Module cache may (re)load from database, which must not block the IOLoop
+        return await IOLoop.current().run_in_executor(None, lambda: self.module_cache.modules)
 
 
 class MainForm(BaseWrhForm):
-    def get(self):
+    async def get(self):
         requested_module_type = self.get_argument('class', '')
+        modules = await self.get_modules()
         kwargs = {
-            'classes': self.installed_module_types,
-            'requested_modules': [m for m in self.modules if m.type == requested_module_type],
+            'classes': list({m.type for m in modules}),
+            'requested_modules': [m for m in modules if m.type == requested_module_type],
             'requested_class': self.module_class_by_wrhid.get(requested_module_type, None)
         }
         self.render("html/index.html", **kwargs)
 
 
 class ModuleRequestForm(BaseWrhForm):
-    @with_session
+    @with_async_session
     async def post(self, session):
         response = ''
         module_class = self.get_argument('class', '')
         request_message = self.get_argument('message', '')
         mclass = self.module_class_by_wrhid.get(module_class, None)
         if mclass:
-            response = await mclass.parse_request(session, request_message)
+            start = time.perf_counter()
+            try:
+                window = mclass.get_request_window(request_message)
+            except ValueError as e:
+                raise tornado.web.HTTPError(400, f'Malformed request: {e}')
+            response = self.response_cache.get(mclass.WRHID, window) if window else None
+            cached = response is not None
+            if not cached:
+                generation = self.response_cache.generation(mclass.WRHID, window) if window else None
+                response = await mclass.parse_request(session, request_message)
+                if window:
+                    self.response_cache.put(mclass.WRHID, window, response, generation)
+            HTTP_REQUEST_SECONDS.labels(mclass.WRHID, 'yes' if cached else 'no').observe(time.perf_counter() - start)
+        self._finish_compressed(response)
+
+    def _finish_compressed(self, response):
+        # Brotli is used when both client and server support it, otherwise Tornado falls back to gzip transform
+        accepted = {e.split(';')[0].strip() for e in self.request.headers.get('Accept-Encoding', '').split(',')}
+        if brotli and 'br' in accepted and len(response) >= COMPRESSION_MIN_LENGTH:
+            self.set_header('Content-Encoding', 'br')
+            self.add_header('Vary', 'Accept-Encoding')
+            response = brotli.compress(response.encode('utf-8'))
         self.finish(response)
 
 
+class MetricsHandler(RequestHandler):
+    """
+    Metrics of this process (summed with snapshots of prefork ingestion workers) in Prometheus text exposition format.
+    """
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.finish(REGISTRY.render())
+
+
+class LiveMeasurementsSocket(WebSocketHandler):
+    """
+    WebSocket pushing measurements of single module as they are stored.
+    Expects the same class argument as /request and message in 'module_id,client_id' format.
+    Every message is JSON list of {"date": ..., "measurement": {...}} objects.
+    """
+
+    def initialize(self, broker):
+        self.broker = broker
+        self.subscription = None
+
+    def open(self):
+        try:
+            module_id, client_id = (int(v) for v in self.get_argument('message', '').split(',')[:2])
+        except ValueError:
+            self.close(code=1008, reason='Malformed message')
+            return
+        self.subscription = self.broker.subscribe(self.get_argument('class', ''), client_id, module_id)
+        IOLoop.current().spawn_callback(self._forward)
+
+    def on_close(self):
+        if self.subscription:
+            self.broker.unsubscribe(self.subscription)
+            self.subscription.push([])  # Wake up forwarding coroutine so it can finish
+
+    async def _forward(self):
+        while self.ws_connection is not None:
+            measurements = await self.subscription.get()
+            if not measurements:
+                continue
+            try:
+                await self.write_message(json.dumps(measurements))
+            except WebSocketClosedError:
+                break
+
+
 class TornadoServer:
     """
     Class responsible for maintaining Tornado server.
     """
 
-    def __init__(self, listening_port, sessionmaker):
+    def __init__(self, listening_port, async_sessionmaker, module_cache, response_cache, broker):
         self.port = listening_port
-        self.sessionmaker = sessionmaker
+        self.broker = broker
+        self.async_sessionmaker = async_sessionmaker
+        self.module_cache = module_cache
+        self.response_cache = response_cache
         self.application = self._create_tornado_app()
         self.server = None
 
@@ -81,11 +153,23 @@ class TornadoServer:
             self.server = None
             tornado.ioloop.IOLoop.instance().stop()
 
+    def stop_from_signal(self):
+        """
+        Stop server running in the main thread from within signal handler.
+        """
+        if self.server:
+            IOLoop.current().add_callback_from_signal(self.stop)
+
     def _create_tornado_app(self):
+        kwargs = {'async_sessionmaker': self.async_sessionmaker, 'module_cache': self.module_cache,
+                  'response_cache': self.response_cache}
         return tornado.web.Application([
-            (r"/", MainForm, {'sessionmaker': self.sessionmaker}),
-            (r"/request", ModuleRequestForm, {'sessionmaker': self.sessionmaker}),
+            (r"/", MainForm, kwargs),
+            (r"/request", ModuleRequestForm, kwargs),
+            (r"/live", LiveMeasurementsSocket, {'broker': self.broker}),
+            (r"/metrics", MetricsHandler),
         ],
             debug=True,
+            compress_response=True,
             static_path=os.path.join(os.path.dirname("db_engine/tornado"), "tornado")
         )
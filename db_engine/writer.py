@@ -0,0 +1,175 @@
+import threading
+import time
+
+from sqlalchemy.exc import SQLAlchemyError, OperationalError
+
+from db_engine.constants import WRITER_BATCH_SIZE, WRITER_FLUSH_INTERVAL, SPOOL_RETRY_INTERVAL
+from db_engine.metrics import INGEST_REJECTED, WRITER_COMMIT_SECONDS, WRITER_COMMIT_LATENCY_SECONDS, WRITER_WRITTEN
+from db_engine.overlord_decorators import with_session
+from db_engine.rollups import update_rollups
+from db_engine.spool import MemoryQueue
+from db_engine.statements import insert_ignoring_duplicates
+from utils.io import log, Color
+
+
+class MeasurementWriter:
+    """
+    Write-behind stage storing decoded measurements in bulk.
+    Queued packets are flushed when batch_size of them is gathered or flush_interval seconds have passed.
+    Rows are grouped per target table and every table gets a single INSERT per flush; rows already stored
+    (same client_id, module_id and timestamp) are skipped, so replayed measurements are not duplicated.
+    Rollup tables of the target table (if any) are updated in the same transaction, as well as anything done by
+    optional prepare callable.
+    Packets are queued in memory by default. With durable spool (see db_engine.spool) they survive restarts and
+    database outages: batches failing because database is unavailable are kept and retried every retry_interval
+    seconds instead of being dropped.
+    Batch which cannot be converted or inserted is retried packet by packet, so only the offending packets are dropped
+    and a poison record never stalls the queue.
+    Listeners registered with add_listener are notified with (client_id, packet) pairs of measurements actually
+    inserted by every committed batch; duplicates and rejected packets are left out (on dialects which cannot return
+    inserted rows, every accepted packet is reported).
+    """
+
+    def __init__(self, sessionmaker, rows_factory, batch_size=WRITER_BATCH_SIZE, flush_interval=WRITER_FLUSH_INTERVAL,
+                 prepare=None, spool=None, retry_interval=SPOOL_RETRY_INTERVAL):
+        """
+        :param sessionmaker: database session factory
+        :param rows_factory: callable converting list of (client_id, packet) pairs into {table: [row dicts]}
+        :param batch_size: maximal number of packets written in one transaction
+        :param flush_interval: maximal time (in seconds) packet waits in the queue
+        :param prepare: optional callable accepting session and list of (client_id, packet) pairs, run in the inserting
+        transaction before measurements are inserted
+        :param spool: optional durable Spool used instead of in-memory queue
+        :param retry_interval: time (in seconds) between attempts to write spooled batch while database is unavailable
+        """
+        self.sessionmaker = sessionmaker
+        self.rows_factory = rows_factory
+        self.prepare = prepare
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self._queue = spool or MemoryQueue()
+        self._durable = spool is not None
+        self._thread = None
+        self._should_end = threading.Event()
+        self._listeners = []
+
+    @property
+    def queue_depth(self):
+        return self._queue.depth
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def put(self, client_id, packet):
+        """
+        :raises queue.Full: when in-memory queue stays full (see MemoryQueue)
+        """
+        self._queue.put((time.time(), client_id, packet))
+
+    def start(self):
+        if not self._thread:
+            self._should_end.clear()
+            self._thread = threading.Thread(target=self._run, name='MeasurementWriter', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops background flushing and synchronously writes everything that is still queued.
+        """
+        self._should_end.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._queue.close()
+
+    def flush(self):
+        """
+        Write queued packets until the queue is empty or database becomes unavailable.
+        """
+        while self._write_next(timeout=0):
+            pass
+
+    def _run(self):
+        while not self._should_end.is_set():
+            try:
+                written = self._write_next(self.flush_interval)
+            except Exception as e:  # Writer thread must outlive anything thrown by the queue or spool
+                log(f'Measurement writer failed: {e}', Color.FAIL)
+                written = False
+            if written is False:
+                self._should_end.wait(self.retry_interval)
+
+    def _write_next(self, timeout):
+        """
+        :return: None when there was nothing to write, otherwise whether the batch has been written
+        """
+        queued, position = self._queue.get_batch(self.batch_size, timeout)
+        if not queued:
+            return None
+        if self._write(queued):
+            self._queue.commit(position)
+            return True
+        self._queue.rewind()
+        return False
+
+    def _write(self, queued):
+        enqueued_at, client_ids, packets = zip(*queued)
+        batch = list(zip(client_ids, packets))
+        try:
+            with WRITER_COMMIT_SECONDS.time():
+                written = self._inserted_packets(batch, self._insert(batch))
+        except Exception as e:  # Also errors of row conversion (e.g. raised by get_rows of a third-party module)
+            if self._durable and isinstance(e, OperationalError):
+                log(f'Database is unavailable ({e}), keeping {self.queue_depth} measurements spooled', Color.FAIL)
+                return False
+            log(f'Bulk insert of {len(batch)} measurements failed ({e}), retrying one by one', Color.WARNING)
+            written = []
+            for packet in batch:
+                try:
+                    written.extend(self._inserted_packets([packet], self._insert([packet])))
+                except Exception as e:
+                    if self._durable and isinstance(e, OperationalError):
+                        return False  # Stored ones are skipped as duplicates on retry
+                    INGEST_REJECTED.labels('database_error' if isinstance(e, SQLAlchemyError)
+                                           else 'invalid_measurement').inc()
+                    log(f'Dropping measurement {packet}: {e}', Color.FAIL)
+        committed_at = time.time()
+        for timestamp in enqueued_at:
+            WRITER_COMMIT_LATENCY_SECONDS.observe(committed_at - timestamp)
+        WRITER_WRITTEN.inc(len(written))
+        for listener in self._listeners:
+            try:
+                listener(written)
+            except Exception as e:
+                log(f'Measurement writer listener {listener} failed: {e}', Color.FAIL)
+        return True
+
+    @with_session
+    def _insert(self, session, batch):
+        """
+        :return: inserted rows of all tables
+        :rtype: list
+        """
+        if self.prepare:
+            self.prepare(session, batch)
+        inserted = []
+        for table, rows in self.rows_factory(batch).items():
+            if rows:
+                table_inserted = insert_ignoring_duplicates(session, table, rows, returning=True)
+                update_rollups(session, table, table_inserted)
+                inserted.extend(table_inserted)
+        return inserted
+
+    @staticmethod
+    def _inserted_packets(batch, rows):
+        # Packets are matched to rows on the unique (client_id, module_id, timestamp) key
+        keys = {(r['client_id'], str(r['module_id']), r['timestamp'].strftime('%Y-%m-%d %H:%M:%S')) for r in rows}
+        inserted = []
+        for client_id, packet in batch:
+            key = (client_id, str(packet.get('module_id')), packet.get('date'))
+            if key in keys:
+                keys.discard(key)
+                inserted.append((client_id, packet))
+        return inserted
@@ -4,8 +4,9 @@ import os
 import sys
 
 from db_engine.constants import DEFAULT_ENGINE_PORT, DEFAULT_TORNADO_PORT, ARGS_PORT, ARGS_TORNADO_PORT, ARGS_PATH, \
-    ARGS_INTERACTIVE
+    ARGS_INTERACTIVE, ARGS_ASYNCIO, ARGS_MAX_IN_FLIGHT, DEFAULT_MAX_IN_FLIGHT, ARGS_WORKERS, ARGS_SPOOL, SPOOL_DIR
 from db_engine.engine import DBEngine
+from db_engine.supervisor import Supervisor
 from utils.io import log, Color
 
 
@@ -16,16 +17,34 @@ def parse_args(args):
     parser.add_argument('--tornado_port', '-T', type=int, help='specifies Tornado port')
     parser.add_argument('--interactive', '-i', nargs='?', const=True,
                         help='whether system should start in interactive mode')
+    parser.add_argument('--asyncio', '-a', action='store_true',
+                        help='whether measurements should be accepted using asyncio instead of thread per connection')
+    parser.add_argument('--max_in_flight', '-m', type=int,
+                        help='maximal number of measurements processed concurrently in asyncio mode')
+    parser.add_argument('--workers', '-w', type=int,
+                        help='number of ingestion processes sharing listening port (Tornado runs in separate one)')
+    parser.add_argument('--spool', '-s', action='store_true',
+                        help=f'whether accepted measurements should be spooled on disk (in {SPOOL_DIR} under --path) '
+                             f'until they are stored in database')
     pargs = parser.parse_args(args)
     return {ARGS_PORT: pargs.port or DEFAULT_ENGINE_PORT, ARGS_TORNADO_PORT: pargs.tornado_port or DEFAULT_TORNADO_PORT,
-            ARGS_PATH: pargs.path or os.getcwd(), ARGS_INTERACTIVE: pargs.interactive or False}
+            ARGS_PATH: pargs.path or os.getcwd(), ARGS_INTERACTIVE: pargs.interactive or False,
+            ARGS_ASYNCIO: pargs.asyncio, ARGS_MAX_IN_FLIGHT: pargs.max_in_flight or DEFAULT_MAX_IN_FLIGHT,
+            ARGS_WORKERS: pargs.workers or 0, ARGS_SPOOL: SPOOL_DIR if pargs.spool else None}
 
 
 if __name__ == '__main__':
     try:
         parsed = parse_args(sys.argv[1:])
         os.chdir(parsed[ARGS_PATH])
-        engine = DBEngine(parsed[ARGS_PORT], parsed[ARGS_TORNADO_PORT])
+        if parsed[ARGS_WORKERS] and not parsed[ARGS_INTERACTIVE]:
+            Supervisor(parsed[ARGS_WORKERS], parsed[ARGS_PORT], parsed[ARGS_TORNADO_PORT],
+                       use_asyncio=parsed[ARGS_ASYNCIO], max_in_flight=parsed[ARGS_MAX_IN_FLIGHT],
+                       spool_dir=parsed[ARGS_SPOOL]).run()
+            sys.exit(0)
+        engine = DBEngine(parsed[ARGS_PORT], parsed[ARGS_TORNADO_PORT], use_asyncio=parsed[ARGS_ASYNCIO],
+                          max_in_flight=parsed[ARGS_MAX_IN_FLIGHT], spool_dir=parsed[ARGS_SPOOL])
+        engine.drain_spools([parsed[ARGS_SPOOL]] if parsed[ARGS_SPOOL] else [])
         if parsed[ARGS_INTERACTIVE]:
             engine.run_interactive()
         else:
@@ -1,14 +1,35 @@
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta
+
 from db_engine.models import Module, Measurement
+from db_engine.rollups import RAW, HOURLY, DAILY, get_rollup_table
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+RangeRequest = namedtuple('RangeRequest', 'module_id client_id from_date until_date points')
 
 
 class ModuleBase:
     """
     Abstract base class for WRH modules.
+    Modules storing numeric measurements may list their columns in rollup_columns to get hourly and daily rollup
+    tables maintained on ingestion, which are used by get_series_query for long date ranges.
+    Ingestion converts measurements in batches with get_rows; modules not implementing it fall back to
+    get_object called for every measurement.
     """
     WRHID = ''
     __abstract__ = True
     tornado_form = (r'^some_path/$', None)
     html_repr = ''
+    rollup_columns = ()
+    resolution_limits = ((timedelta(days=7), RAW), (timedelta(days=31), HOURLY))
+    default_chart_points, max_chart_points = 1000, 5000
+    value_ranges = {}  # column -> (min, max) of accepted values, checked by get_numeric_rows
+    retention = {}  # resolution -> days its rows are kept for (None meaning forever), see db_engine.retention
 
     @classmethod
     def get_html(cls, module: Module) -> str:
@@ -25,13 +46,25 @@ class ModuleBase:
         """
         Parse request and return proper data.
         This is asynchronous coroutine meant to be invoked by Tornado server.
-        :param session: database connection session
+        Session is asynchronous (see db_engine.database.AsyncSessionFactory): statements must be awaited,
+        e.g. (await session.execute(text(query), params)).fetchall(), and it stays open until the coroutine returns.
+        :param session: asynchronous database session
         :param request_string: request string sent via request
         :return: result in form of string
         :rtype: str
         """
         raise NotImplemented('Must declare function body!')
 
+    @classmethod
+    def get_request_window(cls, request_string: str):
+        """
+        Return parsed request describing which measurements the response depends on.
+        Used for caching responses; modules returning None are never cached.
+        :param request_string: request string sent via request
+        :return: RangeRequest or None
+        """
+        return None
+
     @classmethod
     def get_object(cls, measurement_object: Measurement) -> object:
         """
@@ -40,3 +73,172 @@ class ModuleBase:
         :return:
         """
         raise NotImplemented('Must declare function body!')
+
+    @classmethod
+    def get_rows(cls, batch: list):
+        """
+        Convert batch of measurements into plain rows of module table, ready for bulk insert.
+        :param batch: list of (client_id, packet) pairs of this module type
+        :return: (rows, rejected) pair, where rows is list of column dicts and rejected is list of (packet, reason)
+        pairs; None when module does not implement batch conversion and get_object should be used instead
+        """
+        return None
+
+    @classmethod
+    def get_numeric_rows(cls, batch: list, columns: tuple):
+        """
+        get_rows implementation for modules whose measurement consists of numeric values stored in columns
+        of the same name. Measurements missing any of the values or having them outside of value_ranges are rejected.
+        """
+        rows, rejected = [], []
+        for (client_id, packet), timestamp in zip(batch, cls.parse_timestamps([p.get('date') for _, p in batch])):
+            measurement = packet.get('measurement')
+            if timestamp is None or not isinstance(measurement, dict):
+                rejected.append((packet, 'invalid date or measurement'))
+                continue
+            try:
+                row = {c: cls._checked_value(c, measurement.get(c)) for c in columns}
+            except ValueError as e:
+                rejected.append((packet, str(e)))
+                continue
+            row.update(client_id=client_id, module_id=packet['module_id'], timestamp=timestamp)
+            rows.append(row)
+        return rows, rejected
+
+    @classmethod
+    def _checked_value(cls, column, value):
+        if isinstance(value, str):
+            value = float(value)
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise ValueError(f'{column} value {value!r} is not a number')
+        low, high = cls.value_ranges.get(column, (float('-inf'), float('inf')))
+        if not low <= value <= high:
+            raise ValueError(f'{column} value {value} is out of range [{low}, {high}]')
+        return value
+
+    @classmethod
+    def parse_range_request(cls, request_string: str) -> RangeRequest:
+        """
+        Parse 'module_id,client_id,from_date,until_date,points' request string.
+        Dates are in dd-mm-YYYY format; missing range edges and point count are replaced with defaults.
+        Returned until_date is exclusive (end of requested day).
+        :raises ValueError: when module or client id is not a number
+        """
+        request_string += ',' * (max(4 - request_string.count(','), 0))  # Preventing unpacking error
+        module_id, client_id, from_date, until_date, points = request_string.split(',')[:5]
+        from_date = cls._parse_date_string(from_date) or datetime(year=2000, month=1, day=1)
+        until_date = cls._parse_date_string(until_date) or datetime.now().replace(hour=0, minute=0, second=0,
+                                                                                  microsecond=0)
+        points = min(int(points) if points.isdigit() else 0, cls.max_chart_points) or cls.default_chart_points
+        return RangeRequest(int(module_id), int(client_id), from_date, until_date + timedelta(days=1), points)
+
+    @classmethod
+    def pick_resolution(cls, from_date, until_date) -> str:
+        """
+        Pick the coarsest resolution which still gives detailed enough data for requested date range.
+        Resolutions whose rows are not retained for the whole range are skipped in favour of coarser ones.
+        :return: one of RAW, HOURLY or DAILY
+        :rtype: str
+        """
+        if not cls.rollup_columns:
+            return RAW
+        resolutions = (RAW, HOURLY, DAILY)
+        picked = next((resolution for limit, resolution in cls.resolution_limits if until_date - from_date <= limit),
+                      DAILY)
+        now = datetime.now()
+        return next((r for r in resolutions[resolutions.index(picked):]
+                     if not cls.retention.get(r) or from_date >= now - timedelta(days=cls.retention[r])), DAILY)
+
+    @classmethod
+    def get_bucket_seconds(cls, from_date, until_date, points: int) -> float:
+        """
+        Compute width of the downsampling bucket so that requested date range gives at most given number of points.
+        """
+        return max((until_date - from_date).total_seconds() / max(points, 1), 1)
+
+    @classmethod
+    def get_series_query(cls, resolution: str) -> str:
+        """
+        Build query returning per-bucket averages of rollup_columns, then minimum and maximum of every column
+        (all as floats), followed by timestamp label (as text). Extremes keep short peaks visible in downsampled data.
+        Query expects client_id, module_id, from_date, until_date (exclusive) and bucket_seconds parameters,
+        so the number of returned rows never exceeds (until_date - from_date) / bucket_seconds.
+        :param resolution: one of RAW, HOURLY or DAILY
+        :return: SQL query string
+        :rtype: str
+        """
+        if resolution == RAW:
+            averages = ', '.join(f'CAST(round(CAST(avg({c}) AS NUMERIC), 2) AS FLOAT)' for c in cls.rollup_columns)
+            extremes = ', '.join(f'CAST(min({c}) AS FLOAT), CAST(max({c}) AS FLOAT)' for c in cls.rollup_columns)
+            return f"""
+            SELECT {averages}, {extremes}, CAST(min(timestamp) AS TEXT)
+            FROM {cls.__tablename__}
+            WHERE client_id = :client_id and module_id = :module_id
+            and timestamp >= :from_date and timestamp < :until_date
+            GROUP BY floor(extract(EPOCH FROM timestamp) / :bucket_seconds)
+            ORDER BY min(timestamp)
+            """
+        averages = ', '.join(f'CAST(round(CAST(sum({c}_sum) / NULLIF(sum({c}_count), 0) AS NUMERIC), 2) AS FLOAT)'
+                             for c in cls.rollup_columns)
+        extremes = ', '.join(f'min({c}_min), max({c}_max)' for c in cls.rollup_columns)
+        label = 'CAST(min(bucket) AS DATE)' if resolution == DAILY else 'min(bucket)'
+        return f"""
+        SELECT {averages}, {extremes}, CAST({label} AS TEXT)
+        FROM {get_rollup_table(cls.__table__, resolution).name}
+        WHERE client_id = :client_id and module_id = :module_id and bucket >= :from_date and bucket < :until_date
+        GROUP BY floor(extract(EPOCH FROM bucket) / :bucket_seconds)
+        ORDER BY min(bucket)
+        """
+
+    @classmethod
+    def build_chart_response(cls, rows, datasets, **extra) -> str:
+        """
+        Serialize query result into Chart.js data object in a single encoder pass.
+        Rows are transposed into columns, so no value is formatted separately in Python.
+        :param rows: result rows consisting of value columns followed by label column
+        :param datasets: (label, border color) pair for every value column
+        :param extra: additional keys of the data object, e.g. resolution of the series (ignored by Chart.js)
+        :return: JSON string
+        :rtype: str
+        """
+        *values, labels = list(zip(*rows)) or [()] * (len(datasets) + 1)
+        return cls.dump_json(dict(extra, **{
+            'labels': labels,
+            'datasets': [{'label': label, 'data': data, 'borderColor': color}
+                         for (label, color), data in zip(datasets, values)]
+        }))
+
+    @staticmethod
+    def _parse_date_string(date_string):
+        try:
+            date = datetime.strptime(date_string, '%d-%m-%Y')
+        except ValueError:
+            date = None
+        return date
+
+    @staticmethod
+    def parse_timestamps(dates: list) -> list:
+        """
+        Parse measurement dates in '%Y-%m-%d %H:%M:%S' format (e.g. 2017-01-01 12:00:00) in bulk.
+        Every distinct date is parsed only once; dates which are not valid are returned as None.
+        """
+        parsed = {}
+        for date in {d for d in dates if isinstance(d, str)}:
+            try:
+                if len(date) == 19 and date[4] + date[7] + date[10] + date[13] + date[16] == '-- ::' \
+                        and (date[0:4] + date[5:7] + date[8:10] + date[11:13] + date[14:16] + date[17:19]).isdigit():
+                    # Fixed-width fast path, several times faster than strptime
+                    parsed[date] = datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                                            int(date[11:13]), int(date[14:16]), int(date[17:19]))
+                else:
+                    parsed[date] = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                parsed[date] = None
+        return [parsed.get(d) if isinstance(d, str) else None for d in dates]
+
+    @staticmethod
+    def dump_json(obj) -> str:
+        """
+        Serialize object to compact JSON, using ujson if it is installed.
+        """
+        return ujson.dumps(obj) if ujson else json.dumps(obj, separators=(',', ':'))
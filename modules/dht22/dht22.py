@@ -1,8 +1,6 @@
-import asyncio
-from datetime import datetime, timedelta
+from datetime import timedelta
 
-from sqlalchemy import Column, Integer, TIMESTAMP, ForeignKey, DECIMAL
-from tornado_sqlalchemy import as_future
+from sqlalchemy import Column, Integer, TIMESTAMP, ForeignKey, DECIMAL, Index, text
 
 from db_engine import Base
 from db_engine.models import Module, Measurement
@@ -20,6 +18,14 @@ class DHT22(Base, ModuleBase):
     timestamp = Column(TIMESTAMP, nullable=False)
     temperature = Column(DECIMAL(precision=4, scale=2, asdecimal=False))
     humidity = Column(DECIMAL(precision=4, scale=2, asdecimal=False))
+    rollup_columns = ('temperature', 'humidity')
+    value_ranges = {'temperature': (-40, 80), 'humidity': (0, 99.99)}  # Sensor limits within DECIMAL(4, 2)
+    # Averages followed by extremes, in order of series query columns
+    chart_datasets = (('temperature', 'rgb(175,92,22)'), ('humidity', 'rgb(50,50,192)'),
+                      ('temperature min', 'rgba(175,92,22,0.4)'), ('temperature max', 'rgba(175,92,22,0.4)'),
+                      ('humidity min', 'rgba(50,50,192,0.4)'), ('humidity max', 'rgba(50,50,192,0.4)'))
+    __table_args__ = (Index('ux_measurement_dht22_client_module_timestamp', 'client_id', 'module_id', 'timestamp',
+                            unique=True),)
 
     @classmethod
     def get_html(cls, module: Module) -> str:
@@ -31,32 +37,23 @@ class DHT22(Base, ModuleBase):
 
     @classmethod
     async def parse_request(cls, session, request_string: str) -> str:
-        dates, temp_data, hum_data = [], [], []
-        request_string += ',' * (max(3 - request_string.count(','), 0))  # Preventing unpacking error
-        module_id, client_id, from_date, until_date = request_string.split(',')
-        from_date = cls.__parse_date_string(from_date) or datetime(year=2000, month=1, day=1)
-        until_date = cls.__parse_date_string(until_date) or datetime.now()
-        query = cls._get_weekly_detailed_query() if (until_date - from_date) <= timedelta(days=7) \
-            else cls._get_monthly_average_query()
-        data = await asyncio.wrap_future(as_future(session.execute(query,
-                                                                   {'module_id': module_id, 'client_id': client_id,
-                                                                    'from_date': from_date,
-                                                                    'until_date': until_date + timedelta(days=1)
-                                                                    }).fetchall))
-        for temp, hum, date in data:
-            temp_data.append(str(temp))
-            hum_data.append(str(hum))
-            dates.append(f'"{date}"')
-        formatted = """
-                {{
-                    "labels":[{month_list}],
-                    "datasets":[
-                    {{"label":"temperature","data":[{temp_data}],"borderColor":"rgb(175,92,22)"}},
-                    {{"label":"humidity","data":[{hum_data}],"borderColor":"rgb(50,50,192)"}}
-                    ]
-                }}
-                """.format(month_list=','.join(dates), temp_data=','.join(temp_data), hum_data=','.join(hum_data))
-        return formatted
+        request = cls.parse_range_request(request_string)
+        resolution = cls.pick_resolution(request.from_date, request.until_date - timedelta(days=1))
+        bucket_seconds = cls.get_bucket_seconds(request.from_date, request.until_date, request.points)
+        result = await session.execute(text(cls.get_series_query(resolution)), {
+            'module_id': request.module_id, 'client_id': request.client_id, 'from_date': request.from_date,
+            'until_date': request.until_date, 'bucket_seconds': bucket_seconds})
+        data = result.fetchall()
+        return cls.build_chart_response(data, cls.chart_datasets, resolution=resolution, bucket_seconds=bucket_seconds,
+                                        points=request.points)
+
+    @classmethod
+    def get_request_window(cls, request_string: str):
+        return cls.parse_range_request(request_string)
+
+    @classmethod
+    def get_rows(cls, batch: list):
+        return cls.get_numeric_rows(batch, ('temperature', 'humidity'))
 
     @classmethod
     def get_object(cls, measurement_object: Measurement) -> ModuleBase:
@@ -66,31 +63,3 @@ class DHT22(Base, ModuleBase):
             raise ValueError('No point in storing dht22 measurement if both temperature and humidity values are None')
         return cls(id=obj.id, client_id=obj.client_id, module_id=obj.module_id, timestamp=obj.timestamp,
                    temperature=temp, humidity=hum)
-
-    @classmethod
-    def _get_monthly_average_query(cls) -> str:
-        query = f"""
-        SELECT CAST(avg(temperature) AS NUMERIC(4, 2)), CAST(avg(humidity) AS NUMERIC(4, 2)), timestamp::DATE
-        FROM {cls.__tablename__}
-        WHERE client_id = :client_id and timestamp >= :from_date and timestamp <= :until_date
-        GROUP BY timestamp::DATE ORDER BY timestamp::DATE
-        """
-        return query
-
-    @classmethod
-    def _get_weekly_detailed_query(cls) -> str:
-        query = f"""
-        SELECT temperature, humidity, timestamp
-        FROM {cls.__tablename__}
-        WHERE client_id = :client_id and timestamp >= :from_date and timestamp <= :until_date
-        ORDER BY timestamp
-        """
-        return query
-
-    @staticmethod
-    def __parse_date_string(date_string):
-        try:
-            date = datetime.strptime(date_string, '%d-%m-%Y')
-        except ValueError:
-            date = None
-        return date
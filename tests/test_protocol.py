@@ -0,0 +1,77 @@
+import json
+import struct
+import unittest
+
+from db_engine.constants import STREAM_MAGIC_NDJSON, STREAM_MAGIC_LENGTH_PREFIXED
+from db_engine.metrics import INGEST_REJECTED
+from db_engine.protocol import StreamDecoder, IngestionStream, ProtocolError, BATCH_END, INVALID
+
+
+def ndjson(*lines):
+    return STREAM_MAGIC_NDJSON + b''.join(line + b'\n' for line in lines)
+
+
+def record(i):
+    return json.dumps({'token': 't', 'module_id': i}).encode('utf-8')
+
+
+class StreamDecoderTest(unittest.TestCase):
+    def test_legacy_record_split_across_chunks(self):
+        decoder = StreamDecoder()
+        self.assertEqual(decoder.feed(b'{"module_id"'), [])
+        self.assertEqual(decoder.feed(b': 1}\0\0'), [{'module_id': 1}])
+        self.assertTrue(decoder.finished)
+
+    def test_ndjson_malformed_line_is_invalid_and_batch_continues(self):
+        decoder = StreamDecoder()
+        events = decoder.feed(ndjson(record(1), b'{not json', record(2), b''))
+        self.assertEqual(events, [{'token': 't', 'module_id': 1}, INVALID, {'token': 't', 'module_id': 2}, BATCH_END])
+
+    def test_ndjson_close_ends_pending_batch(self):
+        decoder = StreamDecoder()
+        self.assertEqual(decoder.feed(ndjson(record(1))[:-1]), [])
+        self.assertEqual(decoder.close(), [{'token': 't', 'module_id': 1}, BATCH_END])
+
+    def test_length_prefixed_frames(self):
+        frames = b''.join(struct.pack('>I', len(r)) + r for r in (record(1), b'\xff', b''))
+        events = StreamDecoder().feed(STREAM_MAGIC_LENGTH_PREFIXED + frames)
+        self.assertEqual(events, [{'token': 't', 'module_id': 1}, INVALID, BATCH_END])
+
+    def test_oversized_frame_is_rejected(self):
+        with self.assertRaises(ProtocolError):
+            StreamDecoder().feed(STREAM_MAGIC_LENGTH_PREFIXED + struct.pack('>I', 2 ** 31))
+
+
+class IngestionStreamTest(unittest.TestCase):
+    def test_failing_record_is_rejected_and_rest_of_batch_is_processed(self):
+        handled = []
+
+        def handler(data):
+            if data['module_id'] == 4:
+                raise RuntimeError('module_id is not an integer')
+            handled.append(data['module_id'])
+            return True
+
+        failures = INGEST_REJECTED.labels('handler_error').value
+        stream = IngestionStream(handler)
+        reply = stream.feed(ndjson(*(record(i) for i in range(1, 8)), b''))
+        self.assertEqual(json.loads(reply), {'accepted': 6, 'rejected': 1})
+        self.assertEqual(handled, [1, 2, 3, 5, 6, 7])
+        self.assertEqual(INGEST_REJECTED.labels('handler_error').value, failures + 1)
+
+    def test_malformed_and_refused_records_are_counted_per_batch(self):
+        stream = IngestionStream(lambda data: data['module_id'] != 2)
+        reply = stream.feed(ndjson(record(1), b'[', record(2), b'', record(3), b''))
+        self.assertEqual([json.loads(line) for line in reply.splitlines()],
+                         [{'accepted': 1, 'rejected': 2}, {'accepted': 1, 'rejected': 0}])
+
+    def test_legacy_connection_gets_no_acknowledgement(self):
+        received = []
+        stream = IngestionStream(lambda data: received.append(data) or True)
+        self.assertEqual(stream.feed(record(1)), b'')
+        self.assertTrue(stream.finished)
+        self.assertEqual(received, [{'token': 't', 'module_id': 1}])
+
+
+if __name__ == '__main__':
+    unittest.main()